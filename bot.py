@@ -1,7 +1,5 @@
-import os
 import discord
 from discord.ext import commands
-from dotenv import load_dotenv
 from langgraph.graph import StateGraph, END
 from state import AgentState
 from nodes import (
@@ -11,15 +9,22 @@ from nodes import (
     execute_tool_node,
     generate_final_response_node,
     generate_followup_questions_node,
-    set_bot_instance_for_nodes
+    set_bot_instance_for_nodes,
+    discard_progress_message,
+    MIN_FOLLOWUP_QUESTION_LENGTH
 )
-from langchain_core.messages import HumanMessage, AIMessage
+from langchain_core.messages import HumanMessage, AIMessage, BaseMessage
 from tools.db_utils import init_db, load_chat_history, save_chat_history
 from tools.timer_tools import create_timer_tool
-from typing import Dict, Optional, Literal, Any, List
+from typing import Awaitable, Callable, Dict, Iterator, Optional, Literal, Any, List, Set
+import asyncio
+import atexit
 import logging
+import logging.handlers
+import queue
 import base64
 import io
+import itertools
 import aiohttp
 
 from tools.vector_store_utils import VectorStoreManager
@@ -28,13 +33,32 @@ from tools.memory_tools import create_memory_tools
 from tools.image_generation_tools import image_generation_tool
 from langchain_core.tools import BaseTool
 from discord.ui import View, Button
-
-load_dotenv()
-
-logging.basicConfig(level=logging.INFO)
+import config
+
+# ログの書き出しはイベントループのスレッドで行わず、QueueListener のスレッドに任せる
+_log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+logging.basicConfig(level=logging.INFO, handlers=[logging.handlers.QueueHandler(_log_queue)])
+_log_listener = logging.handlers.QueueListener(_log_queue, logging.StreamHandler(), respect_handler_level=True)
+_log_listener.start()
+atexit.register(_log_listener.stop)
 logger = logging.getLogger(__name__)
 
-DISCORD_TOKEN = os.getenv("DISCORD_TOKEN")
+DISCORD_TOKEN = config.DISCORD_TOKEN
+# メッセージごとに参照する設定値は、読み込み時にモジュールの名前へ束縛しておく
+FOLLOWUP_ENABLED = config.FOLLOWUP_ENABLED
+MAX_FOLLOWUP_BUTTONS = config.MAX_FOLLOWUP_BUTTONS
+MAX_ATTACHMENT_TOTAL_BYTES = config.MAX_ATTACHMENT_TOTAL_BYTES
+DISCORD_MESSAGE_LIMIT = 2000
+FOLLOWUP_CUSTOM_ID_PREFIX = "followup_"
+BUTTON_LABEL_LIMIT = 80  # Discordのボタンラベルの最大文字数
+VIEW_COMPONENT_LIMIT = 25  # 1つのViewに載せられるコンポーネント数の上限
+# 埋め込みは1通あたり説明文の合計6000文字までなので、3000文字ずつ2つに分けて詰める
+EMBED_DESCRIPTION_CHUNK = 3000
+EMBEDS_PER_MESSAGE = 2
+# 添付ファイルのダウンロードとWeb検索で使い回す接続数の上限と、アイドル接続を保持する秒数
+HTTP_CONNECTION_LIMIT = 16
+HTTP_KEEPALIVE_SECONDS = 30
+IMAGE_SEND_ERROR_NOTE = "(画像の送信中にエラーが発生しました。)"
 
 intents = discord.Intents.default()
 intents.message_content = True
@@ -44,41 +68,53 @@ class MyBot(commands.Bot):
         super().__init__(*args, **kwargs)
         self.vector_store_manager: Optional[VectorStoreManager] = None
         self.tool_map: Dict[str, BaseTool] = {}
+        self.http_session: Optional[aiohttp.ClientSession] = None
 
     async def setup_hook(self):
-        init_db()
-        print("データベースの準備完了。")
+        # メッセージごとにセッションを作るとTLSハンドシェイクが毎回発生するので、接続プールを1つ共有する
+        self.http_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=HTTP_CONNECTION_LIMIT, keepalive_timeout=HTTP_KEEPALIVE_SECONDS)
+        )
+
+        # DBの初期化とベクトルストアの読み込み (新規作成時は埋め込みAPIの呼び出しを含む) は互いに独立しているので、
+        # スレッドで同時に進めてイベントループを塞がないようにする
+        db_ready, vector_store_result = await asyncio.gather(
+            asyncio.to_thread(init_db),
+            asyncio.to_thread(VectorStoreManager),
+            return_exceptions=True
+        )
+        if isinstance(db_ready, BaseException):
+            raise db_ready
+        logger.info("データベースの準備完了。")
 
         try:
-            self.vector_store_manager = VectorStoreManager()
-            print("ベクトルストアの準備完了。")
-
-            if self.vector_store_manager:
-                remember_tool_instance, recall_tool_instance = create_memory_tools(self.vector_store_manager)
-                temp_tools = [
-                    BraveSearchTool(),
-                    remember_tool_instance,
-                    recall_tool_instance,
-                    image_generation_tool,
-                    create_timer_tool(self)
-                ]
-                self.tool_map = {tool.name: tool for tool in temp_tools}
-                set_bot_instance_for_nodes(self, self.tool_map)
-                print("ツールマップが正常に初期化されました。")
-            else:
-                print("警告: VectorStoreManager が初期化できなかったため、記憶・想起ツールは利用できません。")
-                temp_tools = [
-                    BraveSearchTool(),
-                    image_generation_tool,
-                    create_timer_tool(self)
-                ]
-                self.tool_map = {tool.name: tool for tool in temp_tools}
-                set_bot_instance_for_nodes(self, self.tool_map)
-
+            if isinstance(vector_store_result, BaseException):
+                raise vector_store_result
+            self.vector_store_manager = vector_store_result
+            logger.info("ベクトルストアの準備完了。")
         except ValueError as e:
-            print(f"ベクトルストアの初期化に失敗しました: {e}")
+            logger.error("ベクトルストアの初期化に失敗しました: %s", e)
         except Exception as e:
-            logger.exception(f"予期せぬエラーでベクトルストアの初期化に失敗: {e}")
+            logger.exception("予期せぬエラーでベクトルストアの初期化に失敗: %s", e)
+
+        # ベクトルストアの成否はここで一度だけ判定し、使えない場合は記憶・想起ツール抜きで起動する
+        temp_tools = [
+            BraveSearchTool(http_session=self.http_session),
+            image_generation_tool,
+            create_timer_tool(self)
+        ]
+        if self.vector_store_manager is not None:
+            temp_tools.extend(create_memory_tools(self.vector_store_manager))
+        else:
+            logger.warning("VectorStoreManager が初期化できなかったため、記憶・想起ツールは利用できません。")
+        self.tool_map = {tool.name: tool for tool in temp_tools}
+        set_bot_instance_for_nodes(self, self.tool_map)
+        logger.info("ツールマップが正常に初期化されました。")
+
+    async def close(self):
+        if self.http_session is not None:
+            await self.http_session.close()
+        await super().close()
 
 bot = MyBot(command_prefix='!', intents=intents)
 
@@ -89,7 +125,6 @@ workflow.add_node("process_attachments", process_attachments_node)
 workflow.add_node("decide_action", decide_tool_or_direct_response_node)
 workflow.add_node("execute_tool", execute_tool_node)
 workflow.add_node("generate_response", generate_final_response_node)
-workflow.add_node("generate_followups", generate_followup_questions_node)
 
 workflow.set_entry_point("fetch_chat_history")
 
@@ -98,10 +133,10 @@ workflow.add_edge("process_attachments", "decide_action")
 
 def select_next_node_after_decide_action(state: AgentState) -> Literal["execute_tool", "generate_response"]:
     if state.tool_name:
-        print(f"Conditional edge: Routing to execute_tool for tool: {state.tool_name}")
+        logger.debug("Conditional edge: Routing to execute_tool for tool: %s", state.tool_name)
         return "execute_tool"
     else:
-        print("Conditional edge: Routing to generate_response (no tool called)")
+        logger.debug("Conditional edge: Routing to generate_response (no tool called)")
         return "generate_response"
 
 workflow.add_conditional_edges(
@@ -114,141 +149,345 @@ workflow.add_conditional_edges(
 )
 
 workflow.add_edge("execute_tool", "generate_response")
-workflow.add_edge("generate_response", "generate_followups")
-workflow.add_edge("generate_followups", END)
+# フォローアップ質問の生成はグラフに含めず、応答送信後にバックグラウンドで行う
+workflow.add_edge("generate_response", END)
 
 app = workflow.compile()
 
+# 実行中のバックグラウンドタスクへの参照 (GCによる途中破棄を防ぐ)
+_background_tasks: Set[asyncio.Task] = set()
+
+def _spawn_background(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+# チャンネルID -> 最後に開始した履歴保存タスク。次の読み込みと保存はこの完了を待ってから行う
+_pending_history_saves: Dict[int, asyncio.Task] = {}
+
+async def _save_history_after(previous: Optional[asyncio.Task], channel_id: int, chat_history: List[BaseMessage]):
+    # 同じチャンネルの保存は開始した順に書き込み、古い履歴で新しい履歴を上書きしないようにする
+    if previous:
+        await asyncio.wait((previous,))
+    await asyncio.to_thread(save_chat_history, channel_id, chat_history)
+
+def save_history_in_background(channel_id: int, chat_history: List[BaseMessage]):
+    """履歴の保存 (SQLite) をスレッドで実行し、応答の送信を待たせない。"""
+    task = _spawn_background(_save_history_after(_pending_history_saves.get(channel_id), channel_id, chat_history))
+    _pending_history_saves[channel_id] = task
+
+    def _on_saved(done: asyncio.Task):
+        if _pending_history_saves.get(channel_id) is done:
+            del _pending_history_saves[channel_id]
+        if not done.cancelled() and done.exception():
+            logger.error("チャンネル %s の履歴保存に失敗しました: %s", channel_id, done.exception())
+
+    task.add_done_callback(_on_saved)
+
+async def load_history_after_pending_save(channel_id: int) -> List[BaseMessage]:
+    """同じチャンネルの保存が実行中であれば完了を待ってから履歴を読み込む。"""
+    pending = _pending_history_saves.get(channel_id)
+    if pending:
+        await asyncio.wait((pending,))
+    return await asyncio.to_thread(load_chat_history, channel_id)
+
+def _iter_chunks(text: str, size: int = DISCORD_MESSAGE_LIMIT) -> Iterator[str]:
+    """文字列を size 文字ずつ切り出す。送信した順に1チャンクずつ生成する。"""
+    for i in range(0, len(text), size):
+        yield text[i:i + size]
+
+def _iter_embed_payloads(text: str, mention: Optional[str] = None) -> Iterator[Dict[str, Any]]:
+    """長い応答を埋め込みの説明文に分けて詰め、1通分ずつ送信用の引数を生成する。
+
+    埋め込み内のメンションは通知されないので、mention は最初の1通の本文 (content) に載せる。
+    """
+    chunks = _iter_chunks(text, EMBED_DESCRIPTION_CHUNK)
+    content = mention
+    while group := list(itertools.islice(chunks, EMBEDS_PER_MESSAGE)):
+        yield {"content": content, "embeds": [discord.Embed(description=chunk) for chunk in group]}
+        content = None
+
+async def send_response_chunks(send: Callable[..., Awaitable[discord.Message]], response_text: str, file: Optional[discord.File] = None,
+                               progress_message: Optional[discord.Message] = None, mention: Optional[str] = None,
+                               delivered: Optional[List[discord.Message]] = None) -> discord.Message:
+    """応答を順番に送信し、最後に送信したメッセージを返す。
+
+    通常のメッセージ上限に収まらない応答は埋め込み (Embed) に詰め、1通あたり最大6000文字で送る。
+    固定のsleepは挟まず、レート制限への対応は discord.py 側の429処理に任せる。
+    チャンネル内の表示順を保つため、各メッセージの送信完了を待ってから次を送る。
+    progress_message を渡すと、最初の1通を送った後に (送信に失敗した場合も) それを削除する。
+    編集で書き換えるとメンションの通知が届かないので、応答は常に新しいメッセージとして送る。
+    mention は応答の先頭に付け、埋め込みで送る場合も最初の1通の本文に載せて通知が届くようにする。
+    file は最初の1通に添付する。その送信だけが失敗した場合は画像なしで送り直し、最後に画像の失敗を知らせる。
+    delivered を渡すと、送信できたメッセージを順に追加する。途中で例外が出ても、それまでに届いた分が分かる。
+    """
+    full_text = f"{mention} {response_text}" if mention else response_text
+    # 大半の応答は1通に収まるので、その場合は分割処理を経由しない
+    if len(full_text) <= DISCORD_MESSAGE_LIMIT:
+        payloads: Iterator[Dict[str, Any]] = iter(({"content": full_text},))
+    else:
+        payloads = _iter_embed_payloads(response_text, mention)
+    first_payload = next(payloads)
+    sent_message: Optional[discord.Message] = None
+    file_failed = False
+    try:
+        if file is not None:
+            try:
+                sent_message = await send(**first_payload, file=file)
+            except discord.HTTPException as e:
+                logger.warning("画像付きの送信に失敗したため、画像なしで送信します: %s", e)
+                file_failed = True
+        if sent_message is None:
+            sent_message = await send(**first_payload)
+        if delivered is not None:
+            delivered.append(sent_message)
+    finally:
+        # 応答が表示されてから消すことで、チャンネルに何も表示されない時間を作らない
+        if progress_message is not None:
+            try:
+                await discard_progress_message(progress_message)
+            except discord.HTTPException as e:
+                logger.warning("進捗メッセージを削除できませんでした: %s", e)
+    for payload in payloads:
+        sent_message = await send(**payload)
+        if delivered is not None:
+            delivered.append(sent_message)
+    if file_failed:
+        await send(content=IMAGE_SEND_ERROR_NOTE)
+    return sent_message
+
+async def attach_followup_buttons(target_message: discord.Message, final_state: AgentState, custom_id_seed: str, bot_instance: MyBot):
+    """送信済みの応答メッセージに対してフォローアップ質問を生成し、ボタンとして付与する。"""
+    if not FOLLOWUP_ENABLED:
+        return
+    try:
+        followup_state = await generate_followup_questions_node(final_state)
+    except Exception as e:
+        logger.error("フォローアップ質問の生成中にエラーが発生しました: %s", e)
+        return
+    if not followup_state.followup_questions:
+        return
+
+    followup_view = FollowupView(followup_state.followup_questions, custom_id_seed, bot_instance)
+    try:
+        await target_message.edit(view=followup_view)
+        followup_view.message = target_message
+    except discord.HTTPException as e:
+        logger.warning("フォローアップボタンの付与に失敗しました: %s", e)
+
+def _button_label(text: str) -> str:
+    """ボタンラベルの上限を超える質問文を省略記号付きで切り詰める。"""
+    if len(text) <= BUTTON_LABEL_LIMIT:
+        return text
+    return text[:BUTTON_LABEL_LIMIT - 1] + "…"
+
 class FollowupButton(Button):
-    def __init__(self, label: str, custom_id: str, bot_instance: MyBot):
-        super().__init__(label=label, style=discord.ButtonStyle.secondary, custom_id=custom_id)
+    def __init__(self, prompt_text: str, custom_id: str, bot_instance: MyBot):
+        super().__init__(label=_button_label(prompt_text), style=discord.ButtonStyle.secondary, custom_id=custom_id)
+        # 押下時の入力はラベルではなく構築時に束縛した質問文を使う
+        self.prompt_text = prompt_text
         self.bot_instance = bot_instance
 
     async def callback(self, interaction: discord.Interaction):
-        if self.disabled or (self.view and self.view.is_finished()):
+        # 3秒以内の応答期限に間に合わせるため、何よりも先にインタラクションを確認応答する
+        view = self.view if isinstance(self.view, FollowupView) else None
+        if self.disabled or view is None or view.is_consumed():
             await interaction.response.defer()
             return
+        # 先にメモリ上で押下済みにしてタイムアウト処理を止め、
+        # ボタンの無効化は確認応答そのもの (edit_message) で行う
+        view.consume()
+        await interaction.response.edit_message(view=view)
 
-        user_input_text = self.label
+        user_input_text = self.prompt_text
         channel_id = interaction.channel_id
         server_id = str(interaction.guild_id) if interaction.guild else "DM"
         user_id = str(interaction.user.id)
         thread_id = interaction.channel.id if isinstance(interaction.channel, discord.Thread) else None
 
+        # 履歴の読み込み (SQLite) は進捗メッセージの送信と並行してスレッドで行う
+        history_task = asyncio.create_task(load_history_after_pending_save(channel_id))
         progress_message: Optional[discord.Message] = None
         try:
             progress_message = await interaction.channel.send(f"{interaction.user.mention} `{user_input_text}` について考え中です...")
-            await interaction.response.defer()
         except discord.HTTPException as e:
-            print(f"進捗メッセージの送信に失敗 (FollowupButton): {e}")
-            if not interaction.response.is_done():
-                 await interaction.response.send_message("処理を開始できませんでした。", ephemeral=True)
+            logger.warning("進捗メッセージの送信に失敗 (FollowupButton): %s", e)
+            history_task.cancel()
+            await self._restore_view(interaction, view)
+            await interaction.followup.send("処理を開始できませんでした。", ephemeral=True)
             return
 
-        loaded_chat_history = load_chat_history(channel_id)
-        print(f"Loaded {len(loaded_chat_history)} messages from history for channel {channel_id} (Followup)")
-
-        initial_state_dict = {
-            "input_text": user_input_text,
-            "chat_history": loaded_chat_history + [HumanMessage(content=user_input_text)],
-            "server_id": server_id,
-            "channel_id": channel_id,
-            "user_id": user_id,
-            "thread_id": thread_id,
-            "attachments": [],
-            "progress_message_id": progress_message.id if progress_message else None,
-            "progress_channel_id": progress_message.channel.id if progress_message else None,
-        }
-        current_state = AgentState(**initial_state_dict)
-
+        # 送信済みの応答メッセージ。例外時に、応答が一部でも届いたかどうかの判定に使う
+        delivered: List[discord.Message] = []
         try:
-            print("Invoking LangGraph app for followup...")
+            loaded_chat_history = await history_task
+            logger.debug("Loaded %d messages from history for channel %s (Followup)", len(loaded_chat_history), channel_id)
+            # 読み込んだ履歴は新しいリストなので、コピーせずに今回の入力を追記する
+            loaded_chat_history.append(HumanMessage(content=user_input_text))
+
+            initial_state_dict = {
+                "input_text": user_input_text,
+                "chat_history": loaded_chat_history,
+                "server_id": server_id,
+                "channel_id": channel_id,
+                "user_id": user_id,
+                "thread_id": thread_id,
+                "attachments": [],
+                "progress_message_id": progress_message.id if progress_message else None,
+                "progress_channel_id": progress_message.channel.id if progress_message else None,
+            }
+            current_state = AgentState(**initial_state_dict)
+
+            logger.debug("Invoking LangGraph app for followup...")
             final_state_dict = await app.ainvoke(current_state.model_dump())
             final_state = AgentState(**final_state_dict)
-            print("LangGraph app finished for followup.")
-
-            if progress_message:
-                try:
-                    await progress_message.delete()
-                except discord.NotFound:
-                    print("進捗メッセージが見つからず削除できませんでした (FollowupButton)。")
-                except discord.Forbidden:
-                    print("進捗メッセージの削除権限がありません (FollowupButton)。")
-                except Exception as e:
-                    print(f"進捗メッセージの削除中にエラー (FollowupButton): {e}")
+            logger.debug("LangGraph app finished for followup.")
 
-            ai_response_content = final_state.llm_direct_response
-            if not ai_response_content:
-                ai_response_content = "申し訳ありません、応答を生成できませんでした。"
-            
+            is_error_response = not final_state.llm_direct_response
+            ai_response_content = final_state.llm_direct_response or "申し訳ありません、応答を生成できませんでした。"
+            mention = interaction.user.mention
+        
             history_to_save = final_state.chat_history
-            save_chat_history(channel_id, history_to_save)
-
-            followup_view_after_button_click = None
-            if final_state.followup_questions:
-                followup_view_after_button_click = View(timeout=180)
-                for i, q_text in enumerate(final_state.followup_questions):
-                    button_custom_id = f"followup_interaction_{interaction.id}_{i}"
-                    followup_view_after_button_click.add_item(
-                        FollowupButton(label=q_text, custom_id=button_custom_id, bot_instance=self.bot_instance)
-                    )
-            
+            save_history_in_background(channel_id, history_to_save)
+
+            response_body = ai_response_content
+            image_file: Optional[discord.File] = None
             if final_state.image_output_base64:
+                # 送り直しで応答が重複しないよう、ここで扱うのは画像の準備の失敗だけ (送信の失敗は send_response_chunks が扱う)
                 try:
                     image_bytes = base64.b64decode(final_state.image_output_base64)
                     image_file = discord.File(io.BytesIO(image_bytes), filename="generated_image.png")
-                    await interaction.followup.send(
-                        f'{interaction.user.mention} {ai_response_content}',
-                        file=image_file,
-                        view=followup_view_after_button_click
-                    )
-                    print("Generated image sent to Discord (Followup).")
                 except Exception as img_e:
-                    print(f"Error sending image to Discord (Followup): {img_e}")
-                    await interaction.followup.send(
-                        f'{interaction.user.mention} {ai_response_content}\n(画像の送信中にエラーが発生しました。)',
-                        view=followup_view_after_button_click
-                    )
-            else:
-                await interaction.followup.send(
-                    f'{interaction.user.mention} {ai_response_content}',
-                    view=followup_view_after_button_click
-                )
-
-            if interaction.message:
-                disabled_view = View(timeout=None)
-                for item in interaction.message.components:
-                    if isinstance(item, discord.ActionRow):
-                        for child in item.children:
-                            if isinstance(child, discord.ui.Button):
-                                new_button = Button(label=child.label, style=discord.ButtonStyle.secondary, custom_id=child.custom_id, disabled=True)
-                                disabled_view.add_item(new_button)
-                try:
-                    await interaction.message.edit(view=disabled_view)
-                except discord.NotFound:
-                    pass
+                    logger.warning("Error preparing image for Discord (Followup): %s", img_e)
+                    response_body = f'{ai_response_content}\n{IMAGE_SEND_ERROR_NOTE}'
+            # 進捗メッセージの削除は send_response_chunks に任せ、以降の例外処理では触らない
+            placeholder, progress_message = progress_message, None
+            sent_message = await send_response_chunks(interaction.followup.send, response_body, file=image_file, progress_message=placeholder,
+                                                      mention=mention, delivered=delivered)
+            # 定型のエラー文にはフォローアップを付けないので、生成タスク自体を起動しない
+            if not is_error_response:
+                _spawn_background(attach_followup_buttons(sent_message, final_state, f"interaction_{interaction.id}", self.bot_instance))
 
         except Exception as e:
-            print(f"LangGraphの実行中にエラーが発生しました (Followup): {e}")
+            logger.error("LangGraphの実行中にエラーが発生しました (Followup): %s", e)
             if progress_message:
                 try:
-                    await progress_message.delete()
+                    await discard_progress_message(progress_message)
                 except Exception:
                     pass
-            if not interaction.response.is_done():
-                 await interaction.response.send_message(f"{interaction.user.mention} 申し訳ありません、処理中にエラーが発生しました。", ephemeral=True)
-            else:
-                 await interaction.followup.send(f"{interaction.user.mention} 申し訳ありません、処理中にエラーが発生しました。", ephemeral=True)
+            # 応答が1通も届かなかった場合だけ、エラーを知らせてユーザーが選び直せるようにボタンを戻す
+            if not delivered:
+                await self._restore_view(interaction, view)
+                await interaction.followup.send(f"{interaction.user.mention} 申し訳ありません、処理中にエラーが発生しました。", ephemeral=True)
+
+    async def _restore_view(self, interaction: discord.Interaction, view: "FollowupView"):
+        """押下後の処理が失敗したときに、同じ質問のボタンを押せる状態に戻す。"""
+        # 押下済みのビューは停止していて押下を受け付けないので、作り直したものに差し替える
+        restored_view = view.recreate()
+        try:
+            await interaction.edit_original_response(view=restored_view)
+            restored_view.message = interaction.message
+        except discord.HTTPException as e:
+            logger.warning("フォローアップボタンを元に戻せませんでした: %s", e)
+
+
+class FollowupView(View):
+    def __init__(self, questions: List[str], custom_id_seed: str, bot_instance: MyBot, timeout: float = 180):
+        super().__init__(timeout=timeout)
+        self.message: Optional[discord.Message] = None
+        self._consumed = False
+        # 短すぎる質問はボタンを作る前に除外し、ボタン数も上限で打ち切る
+        max_buttons = min(MAX_FOLLOWUP_BUTTONS, VIEW_COMPONENT_LIMIT)
+        questions = [q for q in questions if len(q) >= MIN_FOLLOWUP_QUESTION_LENGTH][:max_buttons]
+        self._questions = questions
+        self._custom_id_seed = custom_id_seed
+        self._bot_instance = bot_instance
+        for i, q_text in enumerate(questions):
+            button_custom_id = f"{FOLLOWUP_CUSTOM_ID_PREFIX}{custom_id_seed}_{i}"
+            self.add_item(FollowupButton(prompt_text=q_text, custom_id=button_custom_id, bot_instance=bot_instance))
+
+    def is_consumed(self) -> bool:
+        return self._consumed
+
+    def consume(self):
+        """ボタンが押された後に呼び出す。全ボタンを無効化し、タイムアウト処理を止める。"""
+        self._consumed = True
+        for item in self.children:
+            if isinstance(item, Button):
+                item.disabled = True
+        self.stop()
+
+    def recreate(self) -> "FollowupView":
+        """同じ質問・custom_id で、まだ押されていない新しいビューを作る。"""
+        return FollowupView(self._questions, self._custom_id_seed, self._bot_instance, timeout=self.timeout)
+
+    async def on_timeout(self):
+        # 押下済みのビューはコールバック側で無効化済みなので、ここでの編集リクエストは不要
+        if self._consumed or self.message is None:
+            return
+        for item in self.children:
+            if isinstance(item, Button):
+                item.disabled = True
+        try:
+            await self.message.edit(view=self)
+        except discord.HTTPException:
+            pass
+
+
+def _attachment_type(attachment: discord.Attachment) -> Optional[str]:
+    """LangGraphに渡せる添付ファイルの種類 ("image" / "pdf") を返す。対象外なら None。"""
+    if attachment.content_type and attachment.content_type.startswith('image/'):
+        return "image"
+    if attachment.content_type == 'application/pdf':
+        return "pdf"
+    return None
+
+def select_attachments_within_limit(attachments: List[discord.Attachment]) -> List[discord.Attachment]:
+    """ダウンロードする前に、対象外の種類と合計サイズの上限を超える添付ファイルを除外する。"""
+    selected: List[discord.Attachment] = []
+    total_bytes = 0
+    for attachment in attachments:
+        if _attachment_type(attachment) is None:
+            logger.info("Skipping unsupported attachment type: %s (%s)", attachment.filename, attachment.content_type)
+            continue
+        if total_bytes + attachment.size > MAX_ATTACHMENT_TOTAL_BYTES:
+            logger.warning("Skipping attachment %s (%d bytes): total size limit exceeded.", attachment.filename, attachment.size)
+            continue
+        selected.append(attachment)
+        total_bytes += attachment.size
+    return selected
+
+async def download_attachment(session: aiohttp.ClientSession, attachment: discord.Attachment) -> Optional[Dict[str, Any]]:
+    """添付ファイルを1件ダウンロードし、LangGraphに渡す形式に変換する。失敗時は None。"""
+    try:
+        async with session.get(attachment.url) as resp:
+            if resp.status != 200:
+                logger.warning("Failed to download attachment %s: Status %s", attachment.filename, resp.status)
+                return None
+            file_bytes = await resp.read()
+    except Exception as e:
+        logger.warning("Error processing attachment %s: %s", attachment.filename, e)
+        return None
+
+    attachment_type = _attachment_type(attachment)
+    logger.debug("Processed %s attachment: %s", attachment_type, attachment.filename)
+    return {
+        "filename": attachment.filename,
+        "content_type": attachment.content_type,
+        "content": base64.b64encode(file_bytes).decode('utf-8'),
+        "type": attachment_type
+    }
 
 
 @bot.event
 async def on_ready():
-    print(f'Botとしてログインしました: {bot.user}')
+    logger.info("Botとしてログインしました: %s", bot.user)
 
     if bot.vector_store_manager:
-        print("VectorStoreManager は正常に初期化されています。")
+        logger.info("VectorStoreManager は正常に初期化されています。")
     else:
-        print("警告: VectorStoreManager が初期化されていません。記憶・想起機能が動作しない可能性があります。")
+        logger.warning("VectorStoreManager が初期化されていません。記憶・想起機能が動作しない可能性があります。")
 
 @bot.event
 async def on_message(message: discord.Message):
@@ -262,125 +501,100 @@ async def on_message(message: discord.Message):
         user_id = str(message.author.id)
         thread_id = message.channel.id if isinstance(message.channel, discord.Thread) else None
 
-        print(f"Received mention from {message.author.name} in channel {channel_id} (Server: {server_id})")
-        print(f"User input: {user_input_text}")
+        logger.info("Received mention from %s in channel %s (Server: %s)", message.author.name, channel_id, server_id)
+        logger.debug("User input: %s", user_input_text)
 
+        history_task = asyncio.create_task(load_history_after_pending_save(channel_id))
         progress_message: Optional[discord.Message] = None
         try:
-            progress_message = await message.channel.send(f"{message.author.mention} `{user_input_text[:50]}{'...' if len(user_input_text) > 50 else ''}` について考え中です...")
+            input_preview = user_input_text if len(user_input_text) <= 50 else f"{user_input_text[:50]}..."
+            progress_message = await message.channel.send(f"{message.author.mention} `{input_preview}` について考え中です...")
         except discord.HTTPException as e:
-            print(f"進捗メッセージの送信に失敗 (on_message): {e}")
+            logger.warning("進捗メッセージの送信に失敗 (on_message): %s", e)
 
         attachments_data = []
         if message.attachments:
-            print(f"Found {len(message.attachments)} attachments.")
-            for attachment in message.attachments:
-                try:
-                    async with aiohttp.ClientSession() as session:
-                        async with session.get(attachment.url) as resp:
-                            if resp.status == 200:
-                                file_bytes = await resp.read()
-                                encoded_content = base64.b64encode(file_bytes).decode('utf-8')
-                                
-                                if attachment.content_type and attachment.content_type.startswith('image/'):
-                                    attachments_data.append({
-                                        "filename": attachment.filename,
-                                        "content_type": attachment.content_type,
-                                        "content": encoded_content,
-                                        "type": "image"
-                                    })
-                                    print(f"Processed image attachment: {attachment.filename}")
-                                elif attachment.content_type == 'application/pdf':
-                                    attachments_data.append({
-                                        "filename": attachment.filename,
-                                        "content_type": attachment.content_type,
-                                        "content": encoded_content,
-                                        "type": "pdf"
-                                    })
-                                    print(f"Processed PDF attachment: {attachment.filename}")
-                                else:
-                                    print(f"Skipping unsupported attachment type: {attachment.filename} ({attachment.content_type})")
-                            else:
-                                print(f"Failed to download attachment {attachment.filename}: Status {resp.status}")
-                except Exception as e:
-                    print(f"Error processing attachment {attachment.filename}: {e}")
-
-        loaded_chat_history = load_chat_history(channel_id)
-        print(f"Loaded {len(loaded_chat_history)} messages from history for channel {channel_id}")
-
-        initial_state_dict = {
-            "input_text": user_input_text,
-            "chat_history": loaded_chat_history + [HumanMessage(content=user_input_text)],
-            "server_id": server_id,
-            "channel_id": channel_id,
-            "user_id": user_id,
-            "thread_id": thread_id,
-            "attachments": attachments_data,
-            "progress_message_id": progress_message.id if progress_message else None,
-            "progress_channel_id": progress_message.channel.id if progress_message else None,
-        }
-        
-        current_state = AgentState(**initial_state_dict)
-
+            logger.debug("Found %d attachments.", len(message.attachments))
+            # 送れない添付はダウンロードせずに除外し、APIに拒否される大きさのリクエストを作らない
+            attachments_to_download = select_attachments_within_limit(message.attachments)
+            if attachments_to_download:
+                # 添付ファイルは互いに独立しているので同時にダウンロードする (結果の順序は添付順のまま)
+                results = await asyncio.gather(*(download_attachment(bot.http_session, a) for a in attachments_to_download))
+                attachments_data = [r for r in results if r is not None]
+
+        # 送信済みの応答メッセージ。例外時に、応答が一部でも届いたかどうかの判定に使う
+        delivered: List[discord.Message] = []
         try:
-            print("Invoking LangGraph app...")
+            loaded_chat_history = await history_task
+            logger.debug("Loaded %d messages from history for channel %s", len(loaded_chat_history), channel_id)
+            # 読み込んだ履歴は新しいリストなので、コピーせずに今回の入力を追記する
+            loaded_chat_history.append(HumanMessage(content=user_input_text))
+
+            initial_state_dict = {
+                "input_text": user_input_text,
+                "chat_history": loaded_chat_history,
+                "server_id": server_id,
+                "channel_id": channel_id,
+                "user_id": user_id,
+                "thread_id": thread_id,
+                "attachments": attachments_data,
+                "progress_message_id": progress_message.id if progress_message else None,
+                "progress_channel_id": progress_message.channel.id if progress_message else None,
+            }
+
+            current_state = AgentState(**initial_state_dict)
+
+            logger.debug("Invoking LangGraph app...")
             final_state_dict = await app.ainvoke(current_state.model_dump())
             final_state = AgentState(**final_state_dict)
-            print("LangGraph app finished.")
-
-            if progress_message:
-                try:
-                    await progress_message.delete()
-                except discord.NotFound:
-                    print("進捗メッセージが見つからず削除できませんでした (on_message)。")
-                except discord.Forbidden:
-                    print("進捗メッセージの削除権限がありません (on_message)。")
-                except Exception as e:
-                    print(f"進捗メッセージの削除中にエラー (on_message): {e}")
+            logger.debug("LangGraph app finished.")
 
             ai_response_content = final_state.llm_direct_response
-            if not ai_response_content:
+            is_error_response = not ai_response_content
+            if is_error_response:
                 ai_response_content = "申し訳ありません、応答を生成できませんでした。"
-                print("Error: llm_direct_response is empty in final_state.")
-            
-            print(f"Final AI response: {ai_response_content}")
+                logger.error("llm_direct_response is empty in final_state.")
+        
+            logger.debug("Final AI response: %s", ai_response_content)
+            mention = message.author.mention
 
             history_to_save = final_state.chat_history 
-            save_chat_history(channel_id, history_to_save)
-            print(f"Saved {len(history_to_save)} messages to history for channel {channel_id}")
-
-            followup_view = None
-            if final_state.followup_questions:
-                followup_view = View(timeout=180)
-                for i, q_text in enumerate(final_state.followup_questions):
-                    button_custom_id = f"followup_{message.id}_{i}"
-                    followup_view.add_item(FollowupButton(label=q_text, custom_id=button_custom_id, bot_instance=bot))
-            
+            save_history_in_background(channel_id, history_to_save)
+            logger.debug("Saving %d messages to history for channel %s", len(history_to_save), channel_id)
+
+            response_body = ai_response_content
+            image_file: Optional[discord.File] = None
             if final_state.image_output_base64:
+                # 送り直しで応答が重複しないよう、ここで扱うのは画像の準備の失敗だけ (送信の失敗は send_response_chunks が扱う)
                 try:
                     image_bytes = base64.b64decode(final_state.image_output_base64)
                     image_file = discord.File(io.BytesIO(image_bytes), filename="generated_image.png")
-                    await message.channel.send(f'{message.author.mention} {ai_response_content}', file=image_file, view=followup_view)
-                    print("Generated image sent to Discord.")
                 except Exception as img_e:
-                    print(f"Error sending image to Discord: {img_e}")
-                    await message.channel.send(f'{message.author.mention} {ai_response_content}\n(画像の送信中にエラーが発生しました。)', view=followup_view)
-            else:
-                await message.channel.send(f'{message.author.mention} {ai_response_content}', view=followup_view)
+                    logger.warning("Error preparing image for Discord: %s", img_e)
+                    response_body = f'{ai_response_content}\n{IMAGE_SEND_ERROR_NOTE}'
+            # 進捗メッセージの削除は send_response_chunks に任せ、以降の例外処理では触らない
+            placeholder, progress_message = progress_message, None
+            sent_message = await send_response_chunks(message.channel.send, response_body, file=image_file, progress_message=placeholder,
+                                                      mention=mention, delivered=delivered)
+            if not is_error_response:
+                _spawn_background(attach_followup_buttons(sent_message, final_state, str(message.id), bot))
 
         except Exception as e:
-            print(f"LangGraphの実行中にエラーが発生しました: {e}")
+            logger.error("LangGraphの実行中にエラーが発生しました: %s", e)
             if progress_message:
                 try:
-                    await progress_message.delete()
+                    await discard_progress_message(progress_message)
                 except Exception:
                     pass
-            await message.channel.send(f"{message.author.mention} 申し訳ありません、処理中にエラーが発生しました。")
+            # 応答が一部でも届いている場合は、その横に定型のエラー文を重ねない
+            if not delivered:
+                await message.channel.send(f"{message.author.mention} 申し訳ありません、処理中にエラーが発生しました。")
 
     await bot.process_commands(message)
 
 if __name__ == "__main__":
     if DISCORD_TOKEN:
-        bot.run(DISCORD_TOKEN)
+        # ルートロガーは上でキュー経由に設定済みなので、discord.py 側で同期ハンドラーを追加させない
+        bot.run(DISCORD_TOKEN, log_handler=None)
     else:
         print("DISCORD_TOKENが設定されていません。")
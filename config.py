@@ -0,0 +1,53 @@
+import json
+import os
+from typing import Any, Callable, Dict, Mapping, Tuple
+
+from dotenv import load_dotenv
+
+def _as_bool(raw: str) -> bool:
+    return raw.strip().lower() in ("1", "true", "yes", "on")
+
+# 環境変数名 -> (変換関数, デフォルト値)
+# 設定値を追加する場合はここに1行追加するだけでよい
+_SCHEMA: Dict[str, Tuple[Callable[[str], Any], Any]] = {
+    "DISCORD_TOKEN": (str, None),
+    "GEMINI_API_KEY": (str, None),
+    "BRAVE_SEARCH_API_KEY": (str, None),
+    "GEMINI_PRIMARY_MODEL": (str, "gemini-2.5-flash-preview-05-20"),
+    "GEMINI_LOWLOAD_MODEL": (str, "gemini-2.0-flash"),
+    "GEMINI_SECONDARY_MODEL": (str, "gemini-2.0-flash"),
+    "LLM_HEDGE_DELAY_SECONDS": (float, 8.0),
+    "LLM_REQUEST_TIMEOUT_SECONDS": (float, 60.0),
+    # Gemini への同時リクエスト数の上限 (QPMの枠を一度に使い切らないように)
+    "GEMINI_MAX_CONCURRENCY": (int, 8),
+    "GEMINI_IMAGE_MODEL": (str, "gemini-2.0-flash-preview-image-generation"),
+    # 画像生成はテキスト応答より時間が掛かるので、LLM_REQUEST_TIMEOUT_SECONDS とは別に上限を設ける
+    "IMAGE_GENERATION_TIMEOUT_SECONDS": (float, 180.0),
+    # 1メッセージあたりの添付ファイル合計サイズの上限。Base64化すると約4/3倍になり、Geminiのインライン上限(20MB)に収まるように
+    "MAX_ATTACHMENT_TOTAL_BYTES": (int, 14 * 1024 * 1024),
+    "FOLLOWUP_ENABLED": (_as_bool, True),
+    "MAX_FOLLOWUP_BUTTONS": (int, 3),
+}
+
+def _parse_env(env: Mapping[str, str]) -> Dict[str, Any]:
+    """スキーマに従って環境変数を一度の走査で型変換する。"""
+    return {
+        key: default if (raw := env.get(key)) is None else cast(raw)
+        for key, (cast, default) in _SCHEMA.items()
+    }
+
+def build_config_from_env() -> Dict[str, Any]:
+    """.env と環境変数から設定を組み立てる (開発時の通常経路)。"""
+    load_dotenv()
+    return _parse_env(os.environ)
+
+def _load_snapshot(path: str) -> Dict[str, Any]:
+    """tools/bake_config.py が書き出したJSONスナップショットを読み込む。"""
+    with open(path, 'r', encoding='utf-8') as f:
+        snapshot = json.load(f)
+    return {key: snapshot.get(key, default) for key, (_, default) in _SCHEMA.items()}
+
+# CONFIG_SNAPSHOT が指定されていれば .env の解析を行わずにスナップショットを使う
+_snapshot_path = os.environ.get("CONFIG_SNAPSHOT")
+CONFIG: Dict[str, Any] = _load_snapshot(_snapshot_path) if _snapshot_path else build_config_from_env()
+globals().update(CONFIG)
@@ -1,28 +1,47 @@
-import os
+import asyncio
+from functools import lru_cache
+from pathlib import Path
+from typing import Any, Awaitable, Callable, List, Optional, TypeVar
+
 from langchain_google_genai import ChatGoogleGenerativeAI
+from langchain_core.runnables import Runnable
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
-from dotenv import load_dotenv
 from langchain_core.output_parsers import StrOutputParser # StrOutputParserをインポート
+import config
+
+T = TypeVar("T")
 
-load_dotenv()
+# 呼び出しごとに参照する設定値は、読み込み時にモジュールの名前へ束縛しておく
+LLM_REQUEST_TIMEOUT_SECONDS = config.LLM_REQUEST_TIMEOUT_SECONDS
+LLM_HEDGE_DELAY_SECONDS = config.LLM_HEDGE_DELAY_SECONDS
 
 def get_google_api_key() -> str:
     """Google APIキーを環境変数から取得する"""
-    api_key = os.getenv("GEMINI_API_KEY")
+    api_key = config.GEMINI_API_KEY
     if not api_key:
         raise ValueError("GEMINI_API_KEY 環境変数が設定されていません。")
     return api_key
 
+@lru_cache(maxsize=None)
 def load_system_instruction(file_path: str) -> str:
-    with open(file_path, 'r', encoding='utf-8') as f:
-        return f.read()
+    """プロンプトファイルを読み込む。内容は起動中に変わらないので初回の結果を使い回す。"""
+    return Path(file_path).read_text(encoding='utf-8')
+
+def build_llm(model: str, google_api_key: Optional[str] = None, **kwargs: Any) -> ChatGoogleGenerativeAI:
+    """Gemini のチャットモデルを作る。モデルの生成はすべてここを通し、APIキーの扱いを1か所にまとめる。"""
+    return ChatGoogleGenerativeAI(
+        model=model,
+        google_api_key=config.GEMINI_API_KEY if google_api_key is None else google_api_key,
+        **kwargs
+    )
 
 # LLMの初期化
-llm = ChatGoogleGenerativeAI(
-    model=os.getenv("GEMINI_PRIMARY_MODEL", "gemini-2.5-flash-preview-05-20"), # デフォルト値を .env.template に合わせる
-    temperature=0.7,
-    google_api_key=os.getenv("GEMINI_API_KEY")
-    # generation_config={"response_mime_type": "application/json"} # with_structured_output を使用するため削除
+# generation_config={"response_mime_type": "application/json"} は with_structured_output を使用するため指定しない
+llm = build_llm(config.GEMINI_PRIMARY_MODEL, temperature=0.7)
+
+# ヘッジ用の副モデル。GEMINI_SECONDARY_MODEL が空ならヘッジしない
+secondary_llm: Optional[ChatGoogleGenerativeAI] = (
+    build_llm(config.GEMINI_SECONDARY_MODEL, temperature=0.7) if config.GEMINI_SECONDARY_MODEL else None
 )
 
 # プロンプトテンプレートの作成
@@ -35,3 +54,143 @@ prompt = ChatPromptTemplate.from_messages([
 
 # LLMチェーンの作成
 llm_chain = prompt | llm | StrOutputParser() # StrOutputParserを追加
+secondary_llm_chain: Optional[Runnable] = prompt | secondary_llm | StrOutputParser() if secondary_llm else None
+
+def with_request_timeout(aw: Awaitable[T], timeout: Optional[float] = None) -> Awaitable[T]:
+    """LLM呼び出しに上限時間を設ける。SDK既定の待ち時間に任せず、超えたら asyncio.TimeoutError で打ち切る。"""
+    return asyncio.wait_for(aw, LLM_REQUEST_TIMEOUT_SECONDS if timeout is None else timeout)
+
+# プロセス全体での Gemini 同時呼び出し数の上限。バースト時に ResourceExhausted で失敗させるより順番待ちさせる
+# (Python 3.9 以前はセマフォが生成時のイベントループに結び付くので、最初の呼び出し時に作る)
+_llm_semaphore: Optional[asyncio.Semaphore] = None
+
+async def call_llm_limited(call: Callable[[], Awaitable[T]], timeout: Optional[float] = None,
+                           acquired: Optional[asyncio.Event] = None) -> T:
+    """同時実行数の枠を確保してから call を実行する。タイムアウトは枠を確保した後の実行時間だけに掛ける。
+
+    acquired を渡した場合は、枠を確保した時点でそれをセットする。
+    """
+    global _llm_semaphore
+    if _llm_semaphore is None:
+        _llm_semaphore = asyncio.Semaphore(config.GEMINI_MAX_CONCURRENCY)
+    async with _llm_semaphore:
+        if acquired is not None:
+            acquired.set()
+        return await with_request_timeout(call(), timeout)
+
+async def _wait_task_or_event(task: asyncio.Task, event: asyncio.Event, timeout: Optional[float] = None):
+    """task の完了か event のセットのどちらかを、最大 timeout 秒待つ。"""
+    event_task = asyncio.create_task(event.wait())
+    try:
+        await asyncio.wait({task, event_task}, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        event_task.cancel()
+
+async def run_hedged(primary_call: Callable[[], Awaitable[T]], secondary_call: Optional[Callable[[], Awaitable[T]]],
+                     delay: Optional[float] = None, primary_started: Optional[asyncio.Event] = None) -> T:
+    """primary_call を先に実行し、delay 秒以内に成功しなければ secondary_call も並行して実行する。
+
+    先に成功した方の結果を返し、残りはキャンセルする。primary が失敗した場合は即座に secondary を呼ぶ。
+    それぞれの呼び出しは GEMINI_MAX_CONCURRENCY の枠内で行い、LLM_REQUEST_TIMEOUT_SECONDS の上限を設ける。
+    delay は primary が枠を確保した時点から数える。枠の順番待ちでヘッジすると、混雑時に待ち行列を倍にしてしまうため。
+    primary_started を渡した場合は、delay 以内にそれがセットされれば (ストリームの最初のチャンクが届けば)
+    ヘッジせずに primary の完了を待つ。両方失敗した場合は primary の例外を送出する。
+    """
+    if secondary_call is None:
+        return await call_llm_limited(primary_call)
+    if delay is None:
+        delay = LLM_HEDGE_DELAY_SECONDS
+
+    primary_acquired = asyncio.Event()
+    primary_task = asyncio.create_task(call_llm_limited(primary_call, acquired=primary_acquired))
+    pending = {primary_task}
+    errors = []
+    try:
+        await _wait_task_or_event(primary_task, primary_acquired)
+        if primary_started is None:
+            await asyncio.wait(pending, timeout=delay)
+        else:
+            await _wait_task_or_event(primary_task, primary_started, delay)
+            if primary_started.is_set():
+                await asyncio.wait(pending)
+
+        if primary_task.done():
+            pending = set()
+            if primary_task.exception() is None:
+                return primary_task.result()
+            errors.append(primary_task.exception())
+
+        pending.add(asyncio.create_task(call_llm_limited(secondary_call)))
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                errors.append(task.exception())
+        # 両方失敗した場合は primary の例外を優先する
+        primary_error = primary_task.exception()
+        raise primary_error if primary_error is not None else errors[0]
+    finally:
+        for task in pending:
+            task.cancel()
+
+async def ainvoke_hedged(primary: Runnable, secondary: Optional[Runnable], inputs: Any,
+                         delay: Optional[float] = None) -> Any:
+    """run_hedged で primary / secondary の ainvoke をヘッジする。"""
+    return await run_hedged(
+        lambda: primary.ainvoke(inputs),
+        (lambda: secondary.ainvoke(inputs)) if secondary is not None else None,
+        delay
+    )
+
+async def astream_text(chain: Runnable, inputs: Any, started: Optional[asyncio.Event] = None,
+                       on_text: Optional[Callable[[str], Awaitable[None]]] = None,
+                       on_text_interval: float = 0.0) -> str:
+    """文字列を返すチェーンをストリーミングで呼び出し、届いたチャンクを順に集めて連結する。
+
+    on_text を渡した場合は、前回の通知から on_text_interval 秒以上経ってチャンクが届いたときだけ、
+    そこまでの全文を渡して呼び出す。全文の連結は通知する回数分だけで済む。
+    """
+    chunks: List[str] = []
+    loop = asyncio.get_running_loop()
+    next_notify_at = 0.0
+    async for chunk in chain.astream(inputs):
+        chunks.append(chunk)
+        if started is not None and not started.is_set():
+            started.set()
+        if on_text is not None and loop.time() >= next_notify_at:
+            next_notify_at = loop.time() + on_text_interval
+            await on_text("".join(chunks))
+    return "".join(chunks)
+
+async def astream_text_hedged(primary: Runnable, secondary: Optional[Runnable], inputs: Any,
+                              delay: Optional[float] = None,
+                              on_text: Optional[Callable[[str], Awaitable[None]]] = None,
+                              on_text_interval: float = 0.0) -> str:
+    """primary をストリーミングで呼び出し、最初のチャンクが delay 秒以内に届かなければ secondary でヘッジする。
+
+    途中経過 (on_text) は原則 primary の分だけを通知する。両方の途中経過が混ざって表示されるのを避けるため。
+    primary が途中で失敗した場合は、表示済みの primary の途中経過を secondary の分で上書きしていく。
+    """
+    primary_started = asyncio.Event()
+    primary_failed = False
+
+    async def _stream_primary() -> str:
+        nonlocal primary_failed
+        try:
+            return await astream_text(primary, inputs, primary_started, on_text, on_text_interval)
+        except Exception:
+            primary_failed = True
+            raise
+
+    async def _on_secondary_text(text: str):
+        if primary_failed:
+            await on_text(text)
+
+    return await run_hedged(
+        _stream_primary,
+        (lambda: astream_text(secondary, inputs, on_text=_on_secondary_text if on_text else None,
+                              on_text_interval=on_text_interval)) if secondary is not None else None,
+        delay,
+        primary_started
+    )
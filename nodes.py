@@ -1,26 +1,58 @@
 from typing import Callable, List, Dict, Any, Optional, Union
+import asyncio
 import discord
 from discord.ext import commands
+from functools import lru_cache
+import itertools
 import logging
 import json
+import re
 
 from langchain_core.messages import HumanMessage, AIMessage, SystemMessage, BaseMessage
 from state import AgentState, ToolCall, LLMDecisionOutput
-from llm_config import llm_chain, llm
-from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder, PromptTemplate
-from langchain_core.tools import BaseTool
-
-from langchain_core.messages import HumanMessage, AIMessage, SystemMessage, BaseMessage
-from state import AgentState, ToolCall, LLMDecisionOutput
-from llm_config import llm_chain, llm
-from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder, PromptTemplate
+from llm_config import llm_chain, llm, secondary_llm, secondary_llm_chain, ainvoke_hedged, astream_text_hedged, load_system_instruction
+from langchain_core.prompts import PromptTemplate
 from langchain_core.tools import BaseTool
+from tools.discord_tools import get_discord_messages
 
 logger = logging.getLogger(__name__)
 
+MAX_FOLLOWUP_QUESTIONS = 3
+MIN_FOLLOWUP_QUESTION_LENGTH = 3
+FOLLOWUP_MIN_RESPONSE_LENGTH = 80
+_CODE_FENCE_RE = re.compile(r"```(?:json)?\s*(.*?)\s*```", re.DOTALL)
+# 行頭の箇条書き記号・番号 ("- ", "・", "1. " など)
+_LIST_MARKER_RE = re.compile(r"^\s*(?:[-*・]|\d+[.)．])\s*")
+
+PROGRESS_EDIT_MIN_INTERVAL_SECONDS = 0.75
+# 生成途中の応答を進捗メッセージに表示するときの最大文字数 (Discordの上限2000文字に収める)
+PROGRESS_PREVIEW_MAX_LENGTH = 1800
+
+# ツールが失敗を文字列で返すときの先頭 (memory_tools などもこの形式で返す)
+TOOL_ERROR_PREFIX = "エラー:"
+IMAGE_DATA_PREFIX = "image_base64_data::"
+TIMER_SET_SUFFIX = "に設定しました。時間になったらお知らせします。"
+
 _bot_instance: Optional[commands.Bot] = None
 _tool_map: Optional[Dict[str, BaseTool]] = None
 
+# 構造化出力用のラッパーは呼び出しごとに作り直さず、モジュール読み込み時に一度だけ組み立てる
+_decision_llm = llm.with_structured_output(LLMDecisionOutput)
+_secondary_decision_llm = secondary_llm.with_structured_output(LLMDecisionOutput) if secondary_llm else None
+
+class _ProgressEditState:
+    """1つの進捗メッセージについて、未送信の最新内容と送信ループの状態を保持する。"""
+    __slots__ = ("channel_id", "pending_content", "flush_task", "last_edit_at")
+
+    def __init__(self, channel_id: int):
+        self.channel_id = channel_id
+        self.pending_content: Optional[str] = None
+        self.flush_task: Optional[asyncio.Task] = None
+        self.last_edit_at = 0.0
+
+# 進捗メッセージID -> 編集状態。途中の更新は上書きされ、最新の内容だけが送られる
+_progress_edit_states: Dict[int, _ProgressEditState] = {}
+
 def set_bot_instance_for_nodes(bot_instance: commands.Bot, tool_map: Dict[str, BaseTool]):
     global _bot_instance
     global _tool_map
@@ -33,40 +65,72 @@ async def _update_progress_message(state: AgentState, new_content: str):
         logger.warning("Progress update skipped: Bot instance not set.")
         return
     if state.progress_message_id and state.progress_channel_id:
-        channel = _bot_instance.get_channel(state.progress_channel_id)
-        if channel and isinstance(channel, (discord.TextChannel, discord.Thread, discord.DMChannel, discord.GroupChannel)):
-            try:
-                progress_message = await channel.fetch_message(state.progress_message_id)
-                await progress_message.edit(content=new_content)
-                logger.info(f"Progress message updated: {new_content}")
-            except discord.NotFound:
-                logger.warning(f"Progress message (ID: {state.progress_message_id}) not found for update. Clearing from state.")
-                # メッセージが見つからない場合、stateからIDをクリア
-                state.progress_message_id = None 
-                state.progress_channel_id = None
-            except discord.Forbidden:
-                logger.warning(f"Forbidden to edit progress message (ID: {state.progress_message_id}).")
-            except Exception as e:
-                logger.error(f"Error updating progress message (ID: {state.progress_message_id}): {e}", exc_info=True)
-        else:
-            logger.warning(f"Progress update skipped: Channel (ID: {state.progress_channel_id}) not found or not a messageable channel.")
+        edit_state = _progress_edit_states.get(state.progress_message_id)
+        if edit_state is None:
+            edit_state = _progress_edit_states[state.progress_message_id] = _ProgressEditState(state.progress_channel_id)
+        edit_state.pending_content = new_content
+        if edit_state.flush_task is None or edit_state.flush_task.done():
+            edit_state.flush_task = asyncio.create_task(_flush_progress_edits(state.progress_message_id, edit_state))
     else:
         logger.info("Progress update skipped: No progress message ID or channel ID in state.")
 
-from tools.discord_tools import get_discord_messages
-from tools.db_utils import load_chat_history
+async def _show_partial_response(state: AgentState, partial_text: str):
+    """ストリーミング中の応答を進捗メッセージに表示する。編集の間引きは _update_progress_message に任せる。"""
+    if len(partial_text) > PROGRESS_PREVIEW_MAX_LENGTH:
+        partial_text = partial_text[:PROGRESS_PREVIEW_MAX_LENGTH] + "…"
+    await _update_progress_message(state, f"<@{state.user_id}> {partial_text}")
+
+async def _stop_progress_edits(message_id: int):
+    """未送信の編集を破棄し、送信ループの終了を待つ。"""
+    edit_state = _progress_edit_states.pop(message_id, None)
+    if edit_state and edit_state.flush_task and not edit_state.flush_task.done():
+        edit_state.flush_task.cancel()
+        # 後続の削除・書き換えリクエストと進捗の編集リクエストが同時に飛ばないよう、キャンセルの完了を待つ
+        await asyncio.gather(edit_state.flush_task, return_exceptions=True)
+
+async def discard_progress_message(progress_message: discord.Message):
+    """進捗の編集を止めてから進捗メッセージを削除する。削除時の例外は呼び出し元へ送出する。"""
+    await _stop_progress_edits(progress_message.id)
+    await progress_message.delete()
+
+async def _flush_progress_edits(message_id: int, edit_state: _ProgressEditState):
+    # 編集は PROGRESS_EDIT_MIN_INTERVAL_SECONDS に1回まで。待っている間に届いた更新は最新のものだけが残る
+    loop = asyncio.get_running_loop()
+    while edit_state.pending_content is not None:
+        wait_seconds = PROGRESS_EDIT_MIN_INTERVAL_SECONDS - (loop.time() - edit_state.last_edit_at)
+        if wait_seconds > 0:
+            await asyncio.sleep(wait_seconds)
+        content, edit_state.pending_content = edit_state.pending_content, None
+        edit_state.last_edit_at = loop.time()
+        await _edit_progress_message(edit_state.channel_id, message_id, content)
+
+async def _edit_progress_message(channel_id: int, message_id: int, new_content: str):
+    if not _bot_instance:
+        return
+    # fetch_message を挟まず、部分メッセージに対して直接編集リクエストを送る
+    progress_message = _bot_instance.get_partial_messageable(channel_id).get_partial_message(message_id)
+    try:
+        await progress_message.edit(content=new_content)
+        logger.info("Progress message updated: %s", new_content)
+    except discord.NotFound:
+        logger.warning("Progress message (ID: %s) not found for update.", message_id)
+    except discord.Forbidden:
+        logger.warning("Forbidden to edit progress message (ID: %s).", message_id)
+    except Exception as e:
+        logger.error("Error updating progress message (ID: %s): %s", message_id, e, exc_info=True)
 
 async def process_attachments_node(state: AgentState) -> AgentState:
     await _update_progress_message(state, f"<@{state.user_id}> さんのために添付ファイルを処理中です...")
-    print("--- process_attachments_node ---")
+    logger.debug("--- process_attachments_node ---")
     attachments = state.attachments
     input_text = state.input_text
-    chat_history = list(state.chat_history)
 
     if not attachments:
-        print("No attachments found. Skipping attachment processing.")
+        logger.debug("No attachments found. Skipping attachment processing.")
         return state
 
+    # 履歴を書き換えるのは添付がある場合だけなので、コピーもここで作る
+    chat_history = list(state.chat_history)
     content_parts: List[Union[str, Dict[str, Any]]] = []
     if input_text:
         content_parts.append({"type": "text", "text": input_text})
@@ -80,38 +144,43 @@ async def process_attachments_node(state: AgentState) -> AgentState:
         if file_type == "image" and encoded_content:
             image_url = f"data:{content_type};base64,{encoded_content}"
             content_parts.append({"type": "image_url", "image_url": {"url": image_url}})
-            print(f"Added image attachment to content: {filename}")
+            logger.debug("Added image attachment to content: %s", filename)
         elif file_type == "pdf" and encoded_content:
             content_parts.append({
                 "type": "media",
                 "mime_type": "application/pdf",
                 "data": encoded_content,
             })
-            print(f"Added PDF attachment (Base64) to content_parts for LLM: {filename}")
+            logger.debug("Added PDF attachment (Base64) to content_parts for LLM: %s", filename)
         else:
-            print(f"Skipping unsupported attachment type in node: {filename} ({content_type})")
+            logger.debug("Skipping unsupported attachment type in node: %s (%s)", filename, content_type)
 
     if chat_history and isinstance(chat_history[-1], HumanMessage) and chat_history[-1].content == input_text:
         if isinstance(chat_history[-1].content, str):
-            print(f"Popping last HumanMessage with simple text content: {input_text}")
+            logger.debug("Popping last HumanMessage with simple text content: %s", input_text)
             chat_history.pop()
 
     if content_parts:
-        multimodal_human_message = HumanMessage(content=content_parts)
-        updated_chat_history = chat_history + [multimodal_human_message]
-        print("Created and added new multimodal HumanMessage to chat_history.")
+        # chat_history は関数冒頭で作ったコピーなので、そのまま追記してよい
+        chat_history.append(HumanMessage(content=content_parts))
+        updated_chat_history = chat_history
+        logger.debug("Created and added new multimodal HumanMessage to chat_history.")
     else:
         updated_chat_history = chat_history
-        print("No content_parts to create a new HumanMessage. Using existing chat_history.")
+        logger.debug("No content_parts to create a new HumanMessage. Using existing chat_history.")
 
     current_state_dict = state.model_dump()
     current_state_dict["chat_history"] = updated_chat_history
     current_state_dict["attachments"] = []
     return AgentState(**current_state_dict)
 
+# Discordから取得した過去メッセージに付ける目印
+PAST_HUMAN_MESSAGE_PREFIX = "[過去の会話] Human: "
+PAST_AI_MESSAGE_PREFIX = "[過去の会話] AI: "
+
 async def fetch_chat_history(state: AgentState) -> AgentState:
     await _update_progress_message(state, f"<@{state.user_id}> さんのために過去の会話を読み込んでいます...")
-    print("--- fetch_chat_history ---")
+    logger.debug("--- fetch_chat_history ---")
     if not _bot_instance:
         logger.error("Bot instance not set for nodes.")
         current_state_dict = state.dict()
@@ -120,22 +189,25 @@ async def fetch_chat_history(state: AgentState) -> AgentState:
 
     channel_id = state.channel_id
     new_messages = await get_discord_messages(_bot_instance, channel_id, limit=10)
-    
+
+    # 末尾 max_history_length 件だけが残るので、既存履歴と結合してから切り詰めるのではなく必要な分だけ取り出す
+    # 取得したメッセージも、残る末尾の分だけを変換する
+    max_history_length = 5
     prefixed_new_messages: List[BaseMessage] = []
-    for msg in new_messages:
+    for msg in new_messages[-max_history_length:]:
+        content = msg.content
         if isinstance(msg, HumanMessage):
-            content_str = str(msg.content) if isinstance(msg.content, list) else msg.content
-            prefixed_new_messages.append(HumanMessage(content=f"[過去の会話] Human: {content_str}"))
+            content_str = str(content) if isinstance(content, list) else content
+            prefixed_new_messages.append(HumanMessage(content=PAST_HUMAN_MESSAGE_PREFIX + content_str))
         elif isinstance(msg, AIMessage):
-            prefixed_new_messages.append(AIMessage(content=f"[過去の会話] AI: {msg.content}"))
+            prefixed_new_messages.append(AIMessage(content=PAST_AI_MESSAGE_PREFIX + str(content)))
         else:
             prefixed_new_messages.append(msg)
 
-    updated_chat_history = state.chat_history + prefixed_new_messages
-    
-    max_history_length = 5
-    if len(updated_chat_history) > max_history_length:
-        updated_chat_history = updated_chat_history[-max_history_length:]
+    updated_chat_history = prefixed_new_messages
+    remaining = max_history_length - len(updated_chat_history)
+    if remaining > 0 and state.chat_history:
+        updated_chat_history[:0] = state.chat_history[-remaining:]
 
     current_state_dict = state.dict()
     current_state_dict["chat_history"] = updated_chat_history
@@ -143,22 +215,21 @@ async def fetch_chat_history(state: AgentState) -> AgentState:
 
 async def decide_tool_or_direct_response_node(state: AgentState) -> AgentState:
     await _update_progress_message(state, f"<@{state.user_id}> さんのために次に何をすべきか考えています...")
-    print("--- decide_tool_or_direct_response_node ---")
+    logger.debug("--- decide_tool_or_direct_response_node ---")
     input_text = state.input_text
     chat_history = state.chat_history
     server_id = state.server_id
     channel_id = state.channel_id
     user_id = state.user_id
 
-    logger.info(f"decide_tool_or_direct_response_node: chat_history received (length: {len(chat_history)})")
-    for i, msg in enumerate(chat_history):
-        logger.info(f"  [{i}] Type: {type(msg)}, Content: {msg.content[:50]}...")
-        if not isinstance(msg, (HumanMessage, AIMessage, SystemMessage, BaseMessage)):
-            logger.warning(f"  [{i}] Unexpected message type in chat_history: {type(msg)}")
+    logger.info("decide_tool_or_direct_response_node: chat_history received (length: %s)", len(chat_history))
+    # 1件ずつのダンプは DEBUG のときだけ (想定外の型は後段の変換ループで警告される)
+    if logger.isEnabledFor(logging.DEBUG):
+        for i, msg in enumerate(chat_history):
+            logger.debug("  [%s] Type: %s, Content: %s...", i, type(msg), msg.content[:50])
 
     try:
-        with open("prompts/system_instruction.txt", "r", encoding="utf-8") as f:
-            system_instruction_content = f.read()
+        system_instruction_content = load_system_instruction("prompts/system_instruction.txt")
     except FileNotFoundError:
         logger.error("prompts/system_instruction.txt not found.")
         return AgentState(
@@ -178,41 +249,37 @@ async def decide_tool_or_direct_response_node(state: AgentState) -> AgentState:
     )
 
     messages_for_prompt: List[BaseMessage] = [SystemMessage(content=formatted_system_instruction)]
+    # 形式が正しいメッセージは作り直さずにそのまま渡す
     for msg in chat_history:
+        content = msg.content # 同じメッセージの content を何度も参照するのでローカルに束縛する
         if isinstance(msg, HumanMessage):
-            if isinstance(msg.content, list):
-                messages_for_prompt.append(HumanMessage(content=msg.content))
-            elif isinstance(msg.content, str):
-                messages_for_prompt.append(HumanMessage(content=msg.content))
+            if isinstance(content, (list, str)):
+                messages_for_prompt.append(msg)
             else:
-                logger.warning(f"HumanMessage with unexpected content type: {type(msg.content)}. Content: {str(msg.content)[:100]}...")
+                logger.warning("HumanMessage with unexpected content type: %s. Content: %s...", type(content), str(content)[:100])
                 messages_for_prompt.append(HumanMessage(content="[形式不明のメッセージ]"))
 
         elif isinstance(msg, AIMessage):
-            if isinstance(msg.content, str):
-                messages_for_prompt.append(AIMessage(content=msg.content))
+            if isinstance(content, str):
+                messages_for_prompt.append(msg)
             else:
-                logger.warning(f"AIMessage with unexpected content type: {type(msg.content)}. Content: {str(msg.content)[:100]}...")
+                logger.warning("AIMessage with unexpected content type: %s. Content: %s...", type(content), str(content)[:100])
                 messages_for_prompt.append(AIMessage(content="[形式不明のAI応答]"))
 
         elif isinstance(msg, SystemMessage):
-            if isinstance(msg.content, str):
-                messages_for_prompt.append(SystemMessage(content=msg.content))
+            if isinstance(content, str):
+                messages_for_prompt.append(msg)
             else:
-                logger.warning(f"SystemMessage with unexpected content type: {type(msg.content)}. Content: {str(msg.content)[:100]}...")
+                logger.warning("SystemMessage with unexpected content type: %s. Content: %s...", type(content), str(content)[:100])
                 messages_for_prompt.append(SystemMessage(content="[形式不明のシステムメッセージ]"))
         
         else:
-            logger.warning(f"Skipping unexpected message type in chat_history for LLM prompt: {type(msg)}")
+            logger.warning("Skipping unexpected message type in chat_history for LLM prompt: %s", type(msg))
             continue
 
-    prompt_template = ChatPromptTemplate.from_messages(messages_for_prompt)
-
-    structured_llm = llm.with_structured_output(LLMDecisionOutput)
-    chain = prompt_template | structured_llm
-
-    response_obj: Any = await chain.ainvoke({})
-    logger.info(f"LLM structured response object: {response_obj.dict()}")
+    # メッセージ列はそのままモデルに渡せるので、毎ターン履歴全体からプロンプトテンプレートを組み立て直さない
+    response_obj: Any = await ainvoke_hedged(_decision_llm, _secondary_decision_llm, messages_for_prompt)
+    logger.info("LLM structured response object: %s", response_obj.dict())
 
     current_state_dict = state.model_dump() # 先にダンプしておく
 
@@ -221,34 +288,34 @@ async def decide_tool_or_direct_response_node(state: AgentState) -> AgentState:
         tool_call_data = response_obj.tool_call
         direct_response_content = response_obj.direct_response
 
-        print(f"LLM thought: {thought}")
+        logger.debug("LLM thought: %s", thought)
 
         if tool_call_data:
             tool_name = tool_call_data.name
             tool_args = tool_call_data.args # この時点で tool_args は辞書のはず
 
-            print(f"LLM decided to call tool: {tool_name} with args: {tool_args}")
+            logger.debug("LLM decided to call tool: %s with args: %s", tool_name, tool_args)
             current_state_dict["tool_name"] = tool_name
             current_state_dict["tool_args"] = tool_args
             current_state_dict["llm_direct_response"] = None
             return AgentState(**current_state_dict)
 
         elif direct_response_content:
-            print(f"LLM decided to respond directly: {direct_response_content}")
+            logger.debug("LLM decided to respond directly: %s", direct_response_content)
             current_state_dict["llm_direct_response"] = direct_response_content
             current_state_dict["tool_name"] = None
             current_state_dict["tool_args"] = None
             return AgentState(**current_state_dict)
         
         else:
-            logger.error(f"LLMDecisionOutput did not contain tool_call or direct_response: {response_obj.dict()}")
+            logger.error("LLMDecisionOutput did not contain tool_call or direct_response: %s", response_obj.dict())
             current_state_dict["llm_direct_response"] = "AIの応答形式が予期せぬものでした。(判断結果なし)"
             current_state_dict["tool_name"] = None
             current_state_dict["tool_args"] = None
             return AgentState(**current_state_dict)
 
     except Exception as e: # ここで Pydantic の ValidationError も捕捉される
-        logger.error(f"Error processing LLM structured response in decide_node: {e}", exc_info=True)
+        logger.error("Error processing LLM structured response in decide_node: %s", e, exc_info=True)
         current_state_dict = state.model_dump() # state を再ダンプ
         current_state_dict["llm_direct_response"] = (
             "AIの応答を解析中に問題が発生しました。ツールを正しく使用できない可能性があります。"
@@ -261,7 +328,7 @@ async def decide_tool_or_direct_response_node(state: AgentState) -> AgentState:
 async def execute_tool_node(state: AgentState) -> AgentState:
     tool_name = state.tool_name if state.tool_name else "不明なツール"
     await _update_progress_message(state, f"<@{state.user_id}> さんのためにツール「{tool_name}」を実行中です...")
-    print("--- execute_tool_node ---")
+    logger.debug("--- execute_tool_node ---")
     tool_name = state.tool_name
     tool_args = state.tool_args
     input_text = state.input_text
@@ -278,7 +345,8 @@ async def execute_tool_node(state: AgentState) -> AgentState:
             server_id=server_id,
             channel_id=channel_id,
             user_id=user_id,
-            tool_output="エラー: 実行すべきツールが指定されていません。",
+            tool_output=f"{TOOL_ERROR_PREFIX} 実行すべきツールが指定されていません。",
+            tool_error=True,
             tool_name=None,
             tool_args=None
         )
@@ -291,36 +359,41 @@ async def execute_tool_node(state: AgentState) -> AgentState:
             server_id=server_id,
             channel_id=channel_id,
             user_id=user_id,
-            tool_output="エラー: ツールマップが設定されていません。",
+            tool_output=f"{TOOL_ERROR_PREFIX} ツールマップが設定されていません。",
+            tool_error=True,
             tool_name=None,
             tool_args=None
         )
 
     tool = _tool_map.get(tool_name)
     if not tool:
-        logger.error(f"Tool '{tool_name}' not found in _tool_map.")
+        logger.error("Tool '%s' not found in _tool_map.", tool_name)
         return AgentState(
             input_text=input_text,
             chat_history=chat_history,
             server_id=server_id,
             channel_id=channel_id,
             user_id=user_id,
-            tool_output=f"エラー: ツール '{tool_name}' が見つかりません。",
+            tool_output=f"{TOOL_ERROR_PREFIX} ツール '{tool_name}' が見つかりません。",
+            tool_error=True,
             tool_name=None,
             tool_args=None
         )
 
-    print(f"Executing tool: {tool_name} with args: {tool_args}")
+    logger.debug("Executing tool: %s with args: %s", tool_name, tool_args)
     try:
         if tool_args is None:
             raise ValueError("Tool arguments are None.")
         tool_output_result = await tool.ainvoke(tool_args)
-        print(f"Tool '{tool_name}' executed. Output: {str(tool_output_result)[:100]}...")
+        tool_error = False
+        logger.debug("Tool '%s' executed. Output: %s...", tool_name, str(tool_output_result)[:100])
     except Exception as e:
-        logger.error(f"Error executing tool '{tool_name}': {e}", exc_info=True)
-        tool_output_result = f"エラー: ツール '{tool_name}' の実行中に問題が発生しました: {e}"
+        logger.error("Error executing tool '%s': %s", tool_name, e, exc_info=True)
+        tool_output_result = f"{TOOL_ERROR_PREFIX} ツール '{tool_name}' の実行中に問題が発生しました: {e}"
+        tool_error = True
 
     current_state_dict = state.model_dump()
+    current_state_dict["tool_error"] = tool_error
 
     if tool_name == "web_search" and isinstance(tool_output_result, list):
         current_state_dict["search_results"] = tool_output_result
@@ -330,16 +403,99 @@ async def execute_tool_node(state: AgentState) -> AgentState:
         else:
             current_state_dict["tool_output"] = "検索結果はありませんでした。"
     else:
-        current_state_dict["tool_output"] = str(tool_output_result)
+        current_state_dict["tool_output"] = tool_output_result if isinstance(tool_output_result, str) else str(tool_output_result)
 
     current_state_dict["tool_name"] = None
     current_state_dict["tool_args"] = None
     
     return AgentState(**current_state_dict)
 
+# ツール出力の種類 -> 応答生成時にLLMへ渡す指示。ここにない種類はLLMを呼ばずに応答を決める
+_TOOL_RESULT_GUIDANCE = {
+    "error": "以下のツール実行結果（エラーメッセージ）を参考に、ユーザーに状況を伝えてください。",
+    "result": "以下のツール実行結果を参考に、ユーザーの質問に答えてください。",
+}
+# システム指示のうちツール出力より前の固定部分。種類ごとに読み込み時に組み立てておく
+_TOOL_RESULT_SYSTEM_PREFIX = {
+    kind: f"あなたはDiscord AIエージェントのプラナです。ユーザーの質問に丁寧かつ的確に答えてください。{guidance}\n\nツール実行結果:\n"
+    for kind, guidance in _TOOL_RESULT_GUIDANCE.items()
+}
+_TOOL_RESULT_SYSTEM_SUFFIX = "\n\n過去の会話履歴も考慮して、自然な対話を心がけてください。"
+
+def _classify_tool_output(tool_output: str, tool_error: bool = False) -> str:
+    """ツール出力を error / image / timer_set / result のいずれかに振り分ける。"""
+    # 実行失敗は execute_tool_node がフラグで伝えるので、文字列を調べずに確定できる
+    if tool_error or tool_output.startswith(TOOL_ERROR_PREFIX):
+        return "error"
+    if tool_output.startswith(IMAGE_DATA_PREFIX):
+        return "image"
+    # タイマーの確認メッセージは定型文なので、出力全体を走査せず先頭と末尾だけを見る
+    # (完了通知は timer_tools がチャンネルへ直接送るため、ツール出力としては届かない)
+    if tool_output.startswith("タイマーを") and tool_output.endswith(TIMER_SET_SUFFIX):
+        return "timer_set"
+    return "result"
+
+def _convert_history_for_llm(chat_history: List[BaseMessage]) -> List[BaseMessage]:
+    """ツール結果からの応答生成用に、履歴をテキストのみのメッセージへ変換する。"""
+    converted_chat_history: List[BaseMessage] = []
+    logger.info("--- generate_final_response_node (BEFORE CONVERSION LOOP for LLM call) ---")
+    logger.info("Processing chat_history for conversion (length: %s):", len(chat_history))
+    debug_enabled = logger.isEnabledFor(logging.DEBUG)
+    for i, msg_to_convert in enumerate(chat_history):
+        if debug_enabled:
+            logger.debug("  CONVERTING Item %s: type=%s, value='%s...'", i, type(msg_to_convert), str(msg_to_convert.content)[:100])
+        if not isinstance(msg_to_convert, BaseMessage):
+            logger.error("  ERROR @ CONVERSION: Item %s is NOT a BaseMessage subclass! Value: %s", i, msg_to_convert)
+            continue
+        content = msg_to_convert.content
+
+        if isinstance(msg_to_convert, HumanMessage):
+            if isinstance(content, list):
+                # テキスト部分の抽出と添付の有無の判定を1回の走査で行う
+                text_parts = []
+                has_non_text_attachment = False
+                for part in content:
+                    if not isinstance(part, dict):
+                        continue
+                    if part.get("type") == "text":
+                        text_parts.append(part["text"])
+                    else:
+                        has_non_text_attachment = True
+                # 本文と添付の注記を部品として集め、最後に1回だけ連結する
+                segments = []
+                if text_parts:
+                    segments.append("\n".join(text_parts))
+                if has_non_text_attachment:
+                    segments.append("[添付ファイルあり]")
+                processed_content = " ".join(segment for segment in segments if segment) or "[内容のない添付メッセージ]"
+                converted_chat_history.append(HumanMessage(content=processed_content))
+            elif isinstance(content, str):
+                converted_chat_history.append(msg_to_convert)
+            else:
+                logger.warning("HumanMessage with unexpected content type in generate_final_response_node: %s. Content: %s...", type(content), str(content)[:100])
+                converted_chat_history.append(HumanMessage(content="[形式不明のメッセージ]"))
+        
+        elif isinstance(msg_to_convert, AIMessage):
+            if isinstance(content, str):
+                converted_chat_history.append(msg_to_convert)
+            else:
+                logger.warning("AIMessage with unexpected content type in generate_final_response_node: %s. Content: %s...", type(content), str(content)[:100])
+                converted_chat_history.append(AIMessage(content="[形式不明のAI応答]"))
+
+        elif isinstance(msg_to_convert, SystemMessage):
+            if isinstance(content, str):
+                converted_chat_history.append(msg_to_convert)
+            else:
+                logger.warning("SystemMessage with unexpected content type in generate_final_response_node: %s. Content: %s...", type(content), str(content)[:100])
+                converted_chat_history.append(SystemMessage(content="[形式不明のシステムメッセージ]"))
+        
+        else:
+            logger.warning("Skipping unexpected/unhandled message type during conversion in generate_final_response_node: %s", type(msg_to_convert))
+    return converted_chat_history
+
 async def generate_final_response_node(state: AgentState) -> AgentState:
     await _update_progress_message(state, f"<@{state.user_id}> さんのために応答を生成中です...")
-    print("--- generate_final_response_node ---")
+    logger.debug("--- generate_final_response_node ---")
     input_text = state.input_text
     current_chat_history_at_entry = list(state.chat_history)
     tool_name = state.tool_name
@@ -347,176 +503,44 @@ async def generate_final_response_node(state: AgentState) -> AgentState:
     llm_direct_response = state.llm_direct_response
 
     logger.info("--- generate_final_response_node (ENTRY) ---")
-    logger.info(f"Received state.chat_history (length: {len(current_chat_history_at_entry)}):")
-    for i, item in enumerate(current_chat_history_at_entry):
-        logger.info(f"  Item {i}: type={type(item)}, value='{str(item)[:100]}...'")
-        if not isinstance(item, BaseMessage):
-            logger.error(f"  ERROR @ ENTRY: Item {i} is NOT a BaseMessage subclass! Value: {item}")
+    logger.info("Received state.chat_history (length: %s):", len(current_chat_history_at_entry))
+    if logger.isEnabledFor(logging.DEBUG):
+        for i, item in enumerate(current_chat_history_at_entry):
+            logger.debug("  Item %s: type=%s, value='%s...'", i, type(item), str(item)[:100])
+            if not isinstance(item, BaseMessage):
+                logger.error("  ERROR @ ENTRY: Item %s is NOT a BaseMessage subclass! Value: %s", i, item)
 
     final_response_content = ""
     image_output_base64: Optional[str] = None
 
     if llm_direct_response:
         final_response_content = llm_direct_response
-        print(f"Direct LLM response: {final_response_content}")
+        logger.debug("Direct LLM response: %s", final_response_content)
     elif tool_output:
-        image_data_prefix = "image_base64_data::"
-
-        if tool_output.startswith("エラー:"):
-            print(f"Tool execution resulted in an error. Generating response with LLM based on: {tool_output}")
-            
-            system_message_content = (
-                "あなたはDiscord AIエージェントのプラナです。ユーザーの質問に丁寧かつ的確に答えてください。"
-                "以下のツール実行結果（エラーメッセージ）を参考に、ユーザーに状況を伝えてください。\n\n"
-                f"ツール実行結果:\n{tool_output}\n\n"
-                "過去の会話履歴も考慮して、自然な対話を心がけてください。"
-            )
-            
-            converted_chat_history: List[BaseMessage] = []
-            logger.info("--- generate_final_response_node (BEFORE CONVERSION LOOP for LLM call) ---")
-            logger.info(f"Processing chat_history for conversion (length: {len(current_chat_history_at_entry)}):")
-            for i, msg_to_convert in enumerate(current_chat_history_at_entry):
-                logger.info(f"  CONVERTING Item {i}: type={type(msg_to_convert)}, value='{str(msg_to_convert.content)[:100]}...'")
-                if not isinstance(msg_to_convert, BaseMessage):
-                    logger.error(f"  ERROR @ CONVERSION: Item {i} is NOT a BaseMessage subclass! Value: {msg_to_convert}")
-                    continue
-
-                if isinstance(msg_to_convert, HumanMessage):
-                    if isinstance(msg_to_convert.content, list):
-                        text_parts = [part["text"] for part in msg_to_convert.content if isinstance(part, dict) and part.get("type") == "text"]
-                        processed_content = "\n".join(text_parts)
-                        has_non_text_attachment = any(
-                            isinstance(part, dict) and part.get("type") != "text" for part in msg_to_convert.content
-                        )
-                        if has_non_text_attachment:
-                            if processed_content:
-                                processed_content += " [添付ファイルあり]"
-                            else:
-                                processed_content = "[添付ファイルあり]"
-                        if not processed_content:
-                            processed_content = "[内容のない添付メッセージ]"
-                        converted_chat_history.append(HumanMessage(content=processed_content))
-                    elif isinstance(msg_to_convert.content, str):
-                        converted_chat_history.append(HumanMessage(content=msg_to_convert.content))
-                    else:
-                        logger.warning(f"HumanMessage with unexpected content type in generate_final_response_node: {type(msg_to_convert.content)}. Content: {str(msg_to_convert.content)[:100]}...")
-                        converted_chat_history.append(HumanMessage(content="[形式不明のメッセージ]"))
-                
-                elif isinstance(msg_to_convert, AIMessage):
-                    if isinstance(msg_to_convert.content, str):
-                        converted_chat_history.append(AIMessage(content=msg_to_convert.content))
-                    else:
-                        logger.warning(f"AIMessage with unexpected content type in generate_final_response_node: {type(msg_to_convert.content)}. Content: {str(msg_to_convert.content)[:100]}...")
-                        converted_chat_history.append(AIMessage(content="[形式不明のAI応答]"))
+        tool_output_kind = _classify_tool_output(tool_output, state.tool_error)
 
-                elif isinstance(msg_to_convert, SystemMessage):
-                    if isinstance(msg_to_convert.content, str):
-                        converted_chat_history.append(SystemMessage(content=msg_to_convert.content))
-                    else:
-                        logger.warning(f"SystemMessage with unexpected content type in generate_final_response_node: {type(msg_to_convert.content)}. Content: {str(msg_to_convert.content)[:100]}...")
-                        converted_chat_history.append(SystemMessage(content="[形式不明のシステムメッセージ]"))
-                
-                else:
-                    logger.warning(f"Skipping unexpected/unhandled message type during conversion in generate_final_response_node: {type(msg_to_convert)}")
-            
-            response_content_str: str = await llm_chain.ainvoke({
-                "user_input": input_text,
-                "chat_history": converted_chat_history,
-                "system_instruction": system_message_content
-            })
-            final_response_content = response_content_str
-            image_output_base64 = None
-
-
-        elif tool_output.startswith("タイマーを") and "に設定しました。時間になったらお知らせします。" in tool_output:
-            print("Timer setup confirmation received. Setting response content.")
+        if tool_output_kind == "timer_set":
+            logger.debug("Timer setup confirmation received. Setting response content.")
             final_response_content = tool_output
-            image_output_base64 = None
-        elif tool_output.startswith("タイマーを") and "に設定しました。時間になったらお知らせします。" in tool_output:
-            print("Timer setup confirmation received. Setting response content.")
-            final_response_content = tool_output
-            image_output_base64 = None
-        elif "Timer for" in tool_output and "has finished!" in tool_output:
-            print("Timer completion notification received. Setting empty response for bot.py to handle.")
-            final_response_content = ""
-            image_output_base64 = None
-
-
-        elif tool_output.startswith(image_data_prefix):
-            print("Image generation tool output received. Setting fixed response and image data.")
+        elif tool_output_kind == "image":
+            logger.debug("Image generation tool output received. Setting fixed response and image data.")
             final_response_content = "画像を生成しました！"
-            image_output_base64 = tool_output.split(image_data_prefix, 1)[1]
-        
+            image_output_base64 = tool_output[len(IMAGE_DATA_PREFIX):]
         else:
-            print(f"Tool execution resulted in non-error, non-timer, non-image output. Generating response with LLM based on: {tool_output}")
-            
-            system_message_content = (
-                "あなたはDiscord AIエージェントのプラナです。ユーザーの質問に丁寧かつ的確に答えてください。"
-                "以下のツール実行結果を参考に、ユーザーの質問に答えてください。\n\n"
-                f"ツール実行結果:\n{tool_output}\n\n"
-                "過去の会話履歴も考慮して、自然な対話を心がけてください。"
-            )
-            
-            converted_chat_history: List[BaseMessage] = []
-            logger.info("--- generate_final_response_node (BEFORE CONVERSION LOOP for LLM call) ---")
-            logger.info(f"Processing chat_history for conversion (length: {len(current_chat_history_at_entry)}):")
-            for i, msg_to_convert in enumerate(current_chat_history_at_entry):
-                logger.info(f"  CONVERTING Item {i}: type={type(msg_to_convert)}, value='{str(msg_to_convert.content)[:100]}...'")
-                if not isinstance(msg_to_convert, BaseMessage):
-                    logger.error(f"  ERROR @ CONVERSION: Item {i} is NOT a BaseMessage subclass! Value: {msg_to_convert}")
-                    continue
-
-                if isinstance(msg_to_convert, HumanMessage):
-                    if isinstance(msg_to_convert.content, list):
-                        text_parts = [part["text"] for part in msg_to_convert.content if isinstance(part, dict) and part.get("type") == "text"]
-                        processed_content = "\n".join(text_parts)
-                        has_non_text_attachment = any(
-                            isinstance(part, dict) and part.get("type") != "text" for part in msg_to_convert.content
-                        )
-                        if has_non_text_attachment:
-                            if processed_content:
-                                processed_content += " [添付ファイルあり]"
-                            else:
-                                processed_content = "[添付ファイルあり]"
-                        if not processed_content:
-                            processed_content = "[内容のない添付メッセージ]"
-                        converted_chat_history.append(HumanMessage(content=processed_content))
-                    elif isinstance(msg_to_convert.content, str):
-                        converted_chat_history.append(HumanMessage(content=msg_to_convert.content))
-                    else:
-                        logger.warning(f"HumanMessage with unexpected content type in generate_final_response_node: {type(msg_to_convert.content)}. Content: {str(msg_to_convert.content)[:100]}...")
-                        converted_chat_history.append(HumanMessage(content="[形式不明のメッセージ]"))
-                
-                elif isinstance(msg_to_convert, AIMessage):
-                    if isinstance(msg_to_convert.content, str):
-                        converted_chat_history.append(AIMessage(content=msg_to_convert.content))
-                    else:
-                        logger.warning(f"AIMessage with unexpected content type in generate_final_response_node: {type(msg_to_convert.content)}. Content: {str(msg_to_convert.content)[:100]}...")
-                        converted_chat_history.append(AIMessage(content="[形式不明のAI応答]"))
-
-                elif isinstance(msg_to_convert, SystemMessage):
-                    if isinstance(msg_to_convert.content, str):
-                        converted_chat_history.append(SystemMessage(content=msg_to_convert.content))
-                    else:
-                        logger.warning(f"SystemMessage with unexpected content type in generate_final_response_node: {type(msg_to_convert.content)}. Content: {str(msg_to_convert.content)[:100]}...")
-                        converted_chat_history.append(SystemMessage(content="[形式不明のシステムメッセージ]"))
-                
-                else:
-                    logger.warning(f"Skipping unexpected/unhandled message type during conversion in generate_final_response_node: {type(msg_to_convert)}")
-            
-            response_content_str: str = await llm_chain.ainvoke({
+            logger.debug("Generating response with LLM based on tool output (%s): %s", tool_output_kind, tool_output)
+            system_message_content = _TOOL_RESULT_SYSTEM_PREFIX[tool_output_kind] + tool_output + _TOOL_RESULT_SYSTEM_SUFFIX
+            final_response_content = await astream_text_hedged(llm_chain, secondary_llm_chain, {
                 "user_input": input_text,
-                "chat_history": converted_chat_history,
+                "chat_history": _convert_history_for_llm(current_chat_history_at_entry),
                 "system_instruction": system_message_content
-            })
-            final_response_content = response_content_str
-            image_output_base64 = None
+            }, on_text=lambda text: _show_partial_response(state, text), on_text_interval=PROGRESS_EDIT_MIN_INTERVAL_SECONDS)
 
     else:
         final_response_content = "申し訳ありません、応答を生成できませんでした。"
-        print("No direct response or tool output to generate final response.")
+        logger.debug("No direct response or tool output to generate final response.")
 
-    updated_chat_history = current_chat_history_at_entry + [AIMessage(content=final_response_content)]
+    updated_chat_history = current_chat_history_at_entry
+    updated_chat_history.append(AIMessage(content=final_response_content))
 
     return AgentState(
         input_text=input_text,
@@ -535,21 +559,44 @@ async def generate_final_response_node(state: AgentState) -> AgentState:
         should_search_decision=None
     )
 
+@lru_cache(maxsize=1)
+def _get_followup_chains():
+    """フォローアップ用プロンプトを初回だけ読み込み、主モデルとヘッジ用副モデルのチェーンを組み立てて使い回す。"""
+    followup_prompt = PromptTemplate.from_template(load_system_instruction("prompts/generate_followup_prompt.txt"))
+    secondary_chain = followup_prompt | secondary_llm if secondary_llm is not None else None
+    return followup_prompt | llm, secondary_chain
+
+def _parse_followup_lines(text: str) -> List[str]:
+    """JSONとして解析できなかった応答から、1行1質問とみなして質問を抽出する。必要数に達したら打ち切る。"""
+    questions: List[str] = []
+    for line in text.splitlines():
+        question = _LIST_MARKER_RE.sub("", line).strip().strip('",')
+        if len(question) >= MIN_FOLLOWUP_QUESTION_LENGTH:
+            questions.append(question)
+            if len(questions) >= MAX_FOLLOWUP_QUESTIONS:
+                break
+    return questions
+
 async def generate_followup_questions_node(state: AgentState) -> AgentState:
-    await _update_progress_message(state, f"<@{state.user_id}> さんのために追加の質問を考えています...")
-    print("--- generate_followup_questions_node ---")
+    logger.debug("--- generate_followup_questions_node ---")
     ai_final_response = state.llm_direct_response
     chat_history = state.chat_history
 
     if not ai_final_response:
-        print("No AI final response to generate followup questions from.")
+        logger.debug("No AI final response to generate followup questions from.")
+        current_state_dict = state.model_dump()
+        current_state_dict["followup_questions"] = None
+        return AgentState(**current_state_dict)
+
+    # 短い応答や、AI側がユーザーに問い返している応答からは有用な提案がまず出ないため、LLM呼び出しごと省略する
+    if len(ai_final_response) < FOLLOWUP_MIN_RESPONSE_LENGTH or ai_final_response.rstrip().endswith(("?", "？")):
+        logger.debug("AI final response is too short or ends with a question. Skipping followup generation.")
         current_state_dict = state.model_dump()
         current_state_dict["followup_questions"] = None
         return AgentState(**current_state_dict)
 
     try:
-        with open("prompts/generate_followup_prompt.txt", "r", encoding="utf-8") as f:
-            prompt_template_str = f.read()
+        chain, secondary_chain = _get_followup_chains()
     except FileNotFoundError:
         logger.error("prompts/generate_followup_prompt.txt not found.")
         current_state_dict = state.model_dump()
@@ -558,55 +605,64 @@ async def generate_followup_questions_node(state: AgentState) -> AgentState:
 
     history_for_prompt_list = []
     for msg in chat_history[-5:]:
+        content = msg.content
         if isinstance(msg, HumanMessage):
-            if isinstance(msg.content, str):
-                history_for_prompt_list.append(f"Human: {msg.content}")
-            elif isinstance(msg.content, list):
-                 text_content = " ".join([part["text"] for part in msg.content if isinstance(part, dict) and part.get("type") == "text"])
+            if isinstance(content, str):
+                history_for_prompt_list.append(f"Human: {content}")
+            elif isinstance(content, list):
+                 text_content = " ".join(
+                     text for part in content
+                     if isinstance(part, dict) and part.get("type") == "text" and (text := part.get("text"))
+                 )
                  history_for_prompt_list.append(f"Human: {text_content} [添付ファイルあり]")
         elif isinstance(msg, AIMessage):
-            if isinstance(msg.content, str):
-                history_for_prompt_list.append(f"AI: {msg.content}")
+            if isinstance(content, str):
+                history_for_prompt_list.append(f"AI: {content}")
     chat_history_for_followup = "\n".join(history_for_prompt_list)
 
-    prompt = PromptTemplate.from_template(prompt_template_str)
-    
-    chain = prompt | llm 
-    
     try:
-        response_content = await chain.ainvoke({
+        # 主モデルが混雑しているときに提案の表示だけが大きく遅れないよう、決定ノードと同じくヘッジする
+        response_content = await ainvoke_hedged(chain, secondary_chain, {
             "chat_history_for_followup": chat_history_for_followup,
             "ai_final_response": ai_final_response
         })
         
-        if isinstance(response_content, AIMessage):
-            generated_json_str = response_content.content
-        elif isinstance(response_content, str):
-            generated_json_str = response_content
-        else:
-            raise ValueError(f"Unexpected response type from LLM: {type(response_content)}")
+        # チェーンは PromptTemplate | ChatModel なので、戻り値は常に AIMessage
+        generated_json_str = response_content.content
+        if not isinstance(generated_json_str, str):
+            raise ValueError(f"Unexpected response content type from LLM: {type(generated_json_str)}")
 
-        print(f"LLM raw response for followup questions: {generated_json_str}")
+        logger.debug("LLM raw response for followup questions: %s", generated_json_str)
         
-        if "```json" in generated_json_str:
-            generated_json_str = generated_json_str.split("```json")[1].split("```")[0].strip()
-        elif "```" in generated_json_str:
-             generated_json_str = generated_json_str.split("```")[1].strip()
-
+        # フェンスが無い応答 (大半) では正規表現の走査を省く
+        fence_match = _CODE_FENCE_RE.search(generated_json_str) if "```" in generated_json_str else None
+        if fence_match:
+            generated_json_str = fence_match.group(1)
 
         followup_questions_list = json.loads(generated_json_str)
         if isinstance(followup_questions_list, list) and all(isinstance(q, str) for q in followup_questions_list):
-            print(f"Generated followup questions: {followup_questions_list}")
+            # 必要な件数だけ取り出し、残りは strip もしない
+            followup_questions = list(itertools.islice(
+                (q for q in map(str.strip, followup_questions_list) if len(q) >= MIN_FOLLOWUP_QUESTION_LENGTH),
+                MAX_FOLLOWUP_QUESTIONS
+            ))
+            logger.debug("Generated followup questions: %s", followup_questions)
             current_state_dict = state.model_dump()
-            current_state_dict["followup_questions"] = followup_questions_list[:3]
+            current_state_dict["followup_questions"] = followup_questions or None
             return AgentState(**current_state_dict)
         else:
             raise ValueError("LLM did not return a valid list of strings for followup questions.")
 
     except json.JSONDecodeError as e:
-        logger.error(f"Failed to parse JSON for followup questions: {generated_json_str}, Error: {e}")
+        followup_questions = _parse_followup_lines(generated_json_str)
+        if followup_questions:
+            logger.warning("Followup questions were not valid JSON; extracted %s line(s) instead.", len(followup_questions))
+            current_state_dict = state.model_dump()
+            current_state_dict["followup_questions"] = followup_questions
+            return AgentState(**current_state_dict)
+        logger.error("Failed to parse JSON for followup questions: %s, Error: %s", generated_json_str, e)
     except Exception as e:
-        logger.error(f"Error generating followup questions: {e}", exc_info=True)
+        logger.error("Error generating followup questions: %s", e, exc_info=True)
     
     current_state_dict = state.model_dump()
     current_state_dict["followup_questions"] = None
@@ -2,6 +2,17 @@ from typing import List, Optional, Dict, Any, Union
 from langchain_core.messages import BaseMessage, HumanMessage, AIMessage, SystemMessage, ToolMessage
 from pydantic import BaseModel, Field, field_validator, root_validator
 import json # 追加
+import logging
+import re
+
+logger = logging.getLogger(__name__)
+
+# LLMがPythonの辞書形式で出力した場合に、JSONと異なる記法を1回の走査で置き換えるためのパターン
+_PY_LITERAL_RE = re.compile(r"'|True|False|None")
+_PY_TO_JSON_LITERALS = {"'": '"', "True": "true", "False": "false", "None": "null"}
+
+# 辞書形式の履歴の type から復元するメッセージクラス ('tool' は tool_call_id が必要なので別扱い)
+_MESSAGE_CLASS_BY_TYPE = {'human': HumanMessage, 'ai': AIMessage, 'system': SystemMessage}
 
 class AgentState(BaseModel):
     input_text: str = Field(default="") # user_input を input_text に変更
@@ -14,6 +25,7 @@ class AgentState(BaseModel):
     tool_name: Optional[str] = Field(default=None) # LLMが呼び出すと判断したツール名
     tool_args: Optional[Dict[str, Any]] = Field(default=None) # LLMが生成したツール引数
     tool_output: Optional[str] = Field(default=None) # ツールの実行結果
+    tool_error: bool = Field(default=False) # ツールの実行自体が失敗した場合 True (tool_output はエラーメッセージ)
     # --- For Search (既存のものを統合または置換) ---
     search_query: Optional[str] = Field(default=None) # 既存
     search_results: Optional[List[Dict]] = Field(default=None) # 既存
@@ -41,19 +53,16 @@ class AgentState(BaseModel):
 
                 if content is None:
                     # content が None の場合はスキップするか、エラーを発生させる
-                    print(f"Warning: Skipping message with missing content during chat_history validation: {item}")
+                    logger.warning("Skipping message with missing content during chat_history validation: %s", item)
                     continue
                 
                 # content が文字列であることを保証
                 if not isinstance(content, str):
                     content = str(content) # 強制的に文字列に変換
 
-                if msg_type == 'human':
-                    converted_messages.append(HumanMessage(content=content))
-                elif msg_type == 'ai':
-                    converted_messages.append(AIMessage(content=content))
-                elif msg_type == 'system':
-                    converted_messages.append(SystemMessage(content=content))
+                message_class = _MESSAGE_CLASS_BY_TYPE.get(msg_type)
+                if message_class is not None:
+                    converted_messages.append(message_class(content=content))
                 elif msg_type == 'tool':
                     tool_call_id = item.get('tool_call_id', 'unknown_tool_call_id')
                     converted_messages.append(ToolMessage(content=content, tool_call_id=tool_call_id))
@@ -63,7 +72,7 @@ class AgentState(BaseModel):
             elif isinstance(item, BaseMessage):
                 converted_messages.append(item)
             else:
-                print(f"Warning: Skipping unexpected non-BaseMessage type in chat_history during validation: {type(item)}, Value: {item}")
+                logger.warning("Skipping unexpected non-BaseMessage type in chat_history during validation: %s, Value: %s", type(item), item)
         return converted_messages
 
     class Config:
@@ -77,9 +86,14 @@ class ToolCall(BaseModel):
     @classmethod
     def parse_args_if_str(cls, value: Any) -> Dict[str, Any]:
         if isinstance(value, str):
+            # 通常はそのままJSONとして読めるので、書き換えの走査は失敗したときだけ行う
+            try:
+                return json.loads(value)
+            except json.JSONDecodeError:
+                pass
             # シングルクォートをダブルクォートに置換し、True/False/NoneをJSONのtrue/false/nullに変換
             # これはLLMがPythonの辞書形式で出力した場合のフォールバック
-            processed_value = value.replace("'", '"').replace("True", "true").replace("False", "false").replace("None", "null")
+            processed_value = _PY_LITERAL_RE.sub(lambda m: _PY_TO_JSON_LITERALS[m.group(0)], value)
             try:
                 return json.loads(processed_value)
             except json.JSONDecodeError as e:
@@ -0,0 +1,22 @@
+"""現在の .env と環境変数から設定スナップショット(JSON)を書き出す。
+
+使い方: python -m tools.bake_config [出力先パス]
+起動時に CONFIG_SNAPSHOT=<出力先パス> を設定すると、config.py は .env を解析せずにこのファイルを読み込む。
+"""
+import json
+import os
+import sys
+
+DEFAULT_SNAPSHOT_PATH = "config_snapshot.json"
+
+def main(output_path: str = DEFAULT_SNAPSHOT_PATH):
+    # 既存のスナップショットではなく、必ず .env と環境変数から組み立て直す
+    os.environ.pop("CONFIG_SNAPSHOT", None)
+    import config
+
+    with open(output_path, 'w', encoding='utf-8') as f:
+        json.dump(config.build_config_from_env(), f, ensure_ascii=False, indent=2)
+    print(f"設定スナップショットを書き出しました: {output_path}")
+
+if __name__ == "__main__":
+    main(*sys.argv[1:2])
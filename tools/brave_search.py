@@ -1,13 +1,33 @@
-import os
+import asyncio
+import aiohttp
 import requests
-from dotenv import load_dotenv
 from langchain_core.tools import BaseTool, ArgsSchema
 from typing import Type, Dict, List, Optional
 from pydantic import BaseModel, Field
+import config
 
-load_dotenv()
+BRAVE_SEARCH_API_KEY = config.BRAVE_SEARCH_API_KEY
+BRAVE_SEARCH_ENDPOINT = "https://api.search.brave.com/res/v1/web/search"
+# 応答が止まったリクエストで aiohttp 既定の5分間待たされないように上限を設ける
+BRAVE_SEARCH_TIMEOUT_SECONDS = 10
+_BRAVE_SEARCH_TIMEOUT = aiohttp.ClientTimeout(total=BRAVE_SEARCH_TIMEOUT_SECONDS)
+# リクエストヘッダーは APIキーを含めて起動中に変わらないので、一度だけ組み立てる
+_BRAVE_SEARCH_HEADERS = {
+    "Accept": "application/json",
+    "X-Subscription-Token": BRAVE_SEARCH_API_KEY or ""
+}
 
-BRAVE_SEARCH_API_KEY = os.getenv("BRAVE_SEARCH_API_KEY")
+def _parse_search_results(data: Dict) -> List[Dict]:
+    """Brave Search API のレスポンスから タイトル / URL / スニペット を取り出す。"""
+    results = []
+    if "web" in data and "results" in data["web"]:
+        for item in data["web"]["results"]:
+            results.append({
+                "title": item.get("title"),
+                "url": item.get("url"),
+                "snippet": item.get("description") # Brave Searchでは"description"がスニペットに相当
+            })
+    return results
 
 class BraveSearchInput(BaseModel):
     query: str = Field(description="検索するクエリ")
@@ -16,42 +36,52 @@ class BraveSearchTool(BaseTool):
     name: str = "web_search"
     description: str = "最新情報や一般的な知識、特定のトピックについて調べる必要がある場合に使用します。検索結果はタイトル、URL、スニペットのリストとして返されます。"
     args_schema: Optional[ArgsSchema] = BraveSearchInput
+    # Bot が共有する接続プール。渡されていない場合 (単体実行など) だけ、リクエストごとにセッションを作る
+    http_session: Optional[aiohttp.ClientSession] = None
 
     def _run(self, query: str) -> List[Dict]:
         if not BRAVE_SEARCH_API_KEY:
             return [{"error": "BRAVE_SEARCH_API_KEYが設定されていません。"}]
 
-        headers = {
-            "Accept": "application/json",
-            "X-Subscription-Token": BRAVE_SEARCH_API_KEY
-        }
         params = {
             "q": query
         }
         try:
-            response = requests.get("https://api.search.brave.com/res/v1/web/search", headers=headers, params=params)
+            response = requests.get(BRAVE_SEARCH_ENDPOINT, headers=_BRAVE_SEARCH_HEADERS, params=params, timeout=BRAVE_SEARCH_TIMEOUT_SECONDS)
             response.raise_for_status() # HTTPエラーがあれば例外を発生させる
-            data = response.json()
-            
-            results = []
-            if "web" in data and "results" in data["web"]:
-                for item in data["web"]["results"]:
-                    results.append({
-                        "title": item.get("title"),
-                        "url": item.get("url"),
-                        "snippet": item.get("description") # Brave Searchでは"description"がスニペットに相当
-                    })
-            return results
+            return _parse_search_results(response.json())
         except requests.exceptions.RequestException as e:
             return [{"error": f"Brave Search APIリクエストエラー: {e}"}]
         except Exception as e:
             return [{"error": f"検索処理中に予期せぬエラーが発生しました: {e}"}]
 
     async def _arun(self, query: str) -> List[Dict]:
-        # 非同期処理が必要な場合はここに実装。requestsは同期ライブラリなので、
-        # aiohttpなど非同期HTTPクライアントを使用するか、ThreadPoolExecutorでラップする必要がある。
-        # 今回はシンプルに同期_runを呼び出す。
-        return self._run(query)
+        # requests はイベントループを止めてしまうので、非同期経路では aiohttp で直接リクエストする
+        if not BRAVE_SEARCH_API_KEY:
+            return [{"error": "BRAVE_SEARCH_API_KEYが設定されていません。"}]
+
+        params = {
+            "q": query
+        }
+        try:
+            if self.http_session is not None and not self.http_session.closed:
+                data = await self._fetch(self.http_session, params)
+            else:
+                async with aiohttp.ClientSession() as session:
+                    data = await self._fetch(session, params)
+            return _parse_search_results(data)
+        except aiohttp.ClientError as e:
+            return [{"error": f"Brave Search APIリクエストエラー: {e}"}]
+        except asyncio.TimeoutError:
+            return [{"error": f"Brave Search APIが{BRAVE_SEARCH_TIMEOUT_SECONDS}秒以内に応答しませんでした。"}]
+        except Exception as e:
+            return [{"error": f"検索処理中に予期せぬエラーが発生しました: {e}"}]
+
+    @staticmethod
+    async def _fetch(session: aiohttp.ClientSession, params: Dict) -> Dict:
+        async with session.get(BRAVE_SEARCH_ENDPOINT, headers=_BRAVE_SEARCH_HEADERS, params=params, timeout=_BRAVE_SEARCH_TIMEOUT) as response:
+            response.raise_for_status() # HTTPエラーがあれば例外を発生させる
+            return await response.json()
 
 if __name__ == "__main__":
     # テストコード
@@ -1,11 +1,28 @@
 import sqlite3
 import json
 import os
+import logging
 from typing import List, Dict, Any, Optional, Union # Union をインポート
 from langchain_core.messages import BaseMessage, HumanMessage, AIMessage
 
+logger = logging.getLogger(__name__)
+
 DATABASE_PATH = "data/memory.db"
 
+# 保存対象のメッセージクラスと message_type カラムの値の対応
+# 他のメッセージタイプ (SystemMessage, ToolMessageなど) を考慮する場合はここに追加
+_MESSAGE_CLASS_BY_TYPE = {"human": HumanMessage, "ai": AIMessage}
+_MESSAGE_TYPE_BY_CLASS = {cls: msg_type for msg_type, cls in _MESSAGE_CLASS_BY_TYPE.items()}
+
+def _message_type_of(msg: BaseMessage) -> Optional[str]:
+    msg_type = _MESSAGE_TYPE_BY_CLASS.get(type(msg))
+    if msg_type is None:
+        # サブクラス (AIMessageChunk など) は isinstance で判定する
+        for cls, candidate in _MESSAGE_TYPE_BY_CLASS.items():
+            if isinstance(msg, cls):
+                return candidate
+    return msg_type
+
 def init_db():
     """データベースを初期化し、必要なテーブルを作成する。"""
     os.makedirs(os.path.dirname(DATABASE_PATH), exist_ok=True)
@@ -38,44 +55,43 @@ def init_db():
     conn.commit()
     conn.close()
 
-def save_chat_history(channel_id: int, chat_history: List[BaseMessage]):
-    """指定されたチャンネルのチャット履歴をデータベースに保存する。"""
-    conn = sqlite3.connect(DATABASE_PATH)
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM conversation_history WHERE channel_id = ?", (channel_id,))
-
+def _serialize_history_rows(channel_id: int, chat_history: List[BaseMessage]):
+    """保存対象のメッセージを (channel_id, message_index, message_type, content) の行に変換する。"""
     for i, msg in enumerate(chat_history):
-        message_type = ""
-        if isinstance(msg, HumanMessage):
-            message_type = "human"
-        elif isinstance(msg, AIMessage):
-            message_type = "ai"
-        # 他のメッセージタイプ (SystemMessage, ToolMessageなど) を考慮する場合はここに追加
+        message_type = _message_type_of(msg)
+        if not message_type:
+            logger.warning("Unknown message type for message at index %s. Skipping save.", i)
+            continue
 
         content_to_save: str
-        if isinstance(msg.content, (list, dict)): # content がリストまたは辞書の場合
+        if isinstance(msg.content, str): # content が文字列の場合
+            content_to_save = msg.content
+        elif isinstance(msg.content, (list, dict)): # content がリストまたは辞書の場合
             try:
                 content_to_save = json.dumps(msg.content)
             except TypeError as e:
                 # JSONシリアライズできないオブジェクトが含まれる場合のエラーハンドリング
-                print(f"Warning: Could not serialize content to JSON for saving: {e}. Saving as string.")
+                logger.warning("Could not serialize content to JSON for saving: %s. Saving as string.", e)
                 content_to_save = str(msg.content)
-        elif isinstance(msg.content, str): # content が文字列の場合
-            content_to_save = msg.content
         else: # その他の型の場合 (フォールバックとして文字列化)
-            print(f"Warning: Unexpected content type ({type(msg.content)}) for saving. Saving as string.")
+            logger.warning("Unexpected content type (%s) for saving. Saving as string.", type(msg.content))
             content_to_save = str(msg.content)
 
-        if message_type: # message_type が設定されていれば保存
-            cursor.execute(
+        yield (channel_id, i, message_type, content_to_save)
+
+def save_chat_history(channel_id: int, chat_history: List[BaseMessage]):
+    """指定されたチャンネルのチャット履歴をデータベースに保存する。"""
+    conn = sqlite3.connect(DATABASE_PATH)
+    try:
+        # 削除と挿入を1トランザクションにまとめ、挿入は executemany で一括して行う
+        with conn:
+            conn.execute("DELETE FROM conversation_history WHERE channel_id = ?", (channel_id,))
+            conn.executemany(
                 "INSERT INTO conversation_history (channel_id, message_index, message_type, content) VALUES (?, ?, ?, ?)",
-                (channel_id, i, message_type, content_to_save)
+                _serialize_history_rows(channel_id, chat_history)
             )
-        else:
-            print(f"Warning: Unknown message type for message at index {i}. Skipping save.")
-
-    conn.commit()
-    conn.close()
+    finally:
+        conn.close()
 
 def load_chat_history(channel_id: int) -> List[BaseMessage]:
     """指定されたチャンネルのチャット履歴をデータベースからロードする。"""
@@ -100,7 +116,7 @@ def load_chat_history(channel_id: int) -> List[BaseMessage]:
         except json.JSONDecodeError:
             loaded_content = db_content_str
         except Exception as e:
-            print(f"Warning: Error during content deserialization: {e}. Using raw string content.")
+            logger.warning("Error during content deserialization: %s. Using raw string content.", e)
             loaded_content = db_content_str
 
         final_content_for_message: Union[str, List[Union[str, Dict[str, Any]]]]
@@ -121,21 +137,19 @@ def load_chat_history(channel_id: int) -> List[BaseMessage]:
                     processed_list.append(item)
                 else:
                     # 他の型（int, float, bool, None など）は文字列に変換
-                    print(f"Warning: Item at index {item_idx} in loaded list is not str or dict (type: {type(item)}). Converting to string.")
+                    logger.warning("Item at index %s in loaded list is not str or dict (type: %s). Converting to string.", item_idx, type(item))
                     processed_list.append(str(item))
             final_content_for_message = processed_list
         else:
             # loaded_content が上記の try-except ブロックから正しく型付けされていれば、
             # このケースには到達しないはず (str, List[Any], Dict[str, Any])
             # ただし、念のためフォールバック処理
-            print(f"Warning: Unexpected type for loaded_content ({type(loaded_content)}). Attempting to convert to string.")
+            logger.warning("Unexpected type for loaded_content (%s). Attempting to convert to string.", type(loaded_content))
             final_content_for_message = str(loaded_content)
 
-        if msg_type == "human":
-            messages.append(HumanMessage(content=final_content_for_message))
-        elif msg_type == "ai":
-            messages.append(AIMessage(content=final_content_for_message))
-        # 他のメッセージタイプをロードする場合の処理をここに追加
+        message_class = _MESSAGE_CLASS_BY_TYPE.get(msg_type)
+        if message_class is not None:
+            messages.append(message_class(content=final_content_for_message))
     conn.close()
     return messages
 
@@ -171,10 +185,10 @@ def save_memory(
         # UNIQUE制約違反の場合 (同じserver_id, channel_id, user_id, keyの組み合わせが既に存在)
         # memory_key が None の可能性があるのでチェック
         key_info = f"key '{memory_key}'" if memory_key else "an unknown key"
-        print(f"Warning: Memory with {key_info} already exists for user {user_id} in {server_id}/{channel_id}. Skipping insertion.")
+        logger.warning("Memory with %s already exists for user %s in %s/%s. Skipping insertion.", key_info, user_id, server_id, channel_id)
         return None
     except Exception as e:
-        print(f"Error saving memory to DB: {e}")
+        logger.error("Error saving memory to DB: %s", e)
         return None
     finally:
         conn.close()
@@ -1,20 +1,26 @@
+import logging
 from discord.ext import commands
 import discord # discordモジュールをインポート
 from typing import List, Dict, Any
 from langchain_core.messages import BaseMessage, HumanMessage, AIMessage
 
+logger = logging.getLogger(__name__)
+
+# メッセージ履歴を持つチャンネルタイプ (呼び出しのたびにタプルを組み立てない)
+HISTORY_CHANNEL_TYPES = (discord.TextChannel, discord.Thread, discord.DMChannel, discord.GroupChannel)
+
 async def get_discord_messages(bot: commands.Bot, channel_id: int, limit: int = 10) -> List[BaseMessage]:
     """
     指定されたチャンネルからメッセージ履歴を取得し、LangChainのBaseMessage形式に変換する。
     """
     channel = bot.get_channel(channel_id)
     if not channel:
-        print(f"チャンネルID {channel_id} が見つかりません。")
+        logger.warning("チャンネルID %s が見つかりません。", channel_id)
         return []
 
     # メッセージ履歴を持つチャンネルタイプか確認
-    if not isinstance(channel, (discord.TextChannel, discord.Thread, discord.DMChannel, discord.GroupChannel)):
-        print(f"チャンネルID {channel_id} はメッセージ履歴を持たないチャンネルタイプです: {type(channel)}")
+    if not isinstance(channel, HISTORY_CHANNEL_TYPES):
+        logger.warning("チャンネルID %s はメッセージ履歴を持たないチャンネルタイプです: %s", channel_id, type(channel))
         return []
 
     messages = []
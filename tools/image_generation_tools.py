@@ -1,56 +1,69 @@
 import base64
 import io
-import os
+from functools import lru_cache
 from typing import Type
 
-from langchain_core.messages import AIMessage, BaseMessage
+from langchain_core.messages import BaseMessage
 from pydantic import BaseModel, Field
 from langchain_core.tools import BaseTool, StructuredTool
 from langchain_google_genai import ChatGoogleGenerativeAI
 
-from llm_config import get_google_api_key
+import config
+from llm_config import build_llm, call_llm_limited, get_google_api_key
+
+# 画像生成モデルに画像とテキストの両方を返させる設定。呼び出しごとに作らず使い回す
+IMAGE_GENERATION_CONFIG = {"response_modalities": ["TEXT", "IMAGE"]}
+IMAGE_GENERATION_TIMEOUT_SECONDS = config.IMAGE_GENERATION_TIMEOUT_SECONDS
 
 class ImageGenerationInput(BaseModel):
     """Input for image generation tool."""
     prompt: str = Field(description="The detailed prompt for image generation.")
 
+def _get_image_base64(response: BaseMessage) -> str:
+    # AIMessageのcontentはリスト形式で、辞書やAIMessageChunkを含む可能性がある
+    # image_urlはAIMessageChunkのadditional_kwargsに含まれる場合がある
+    content = getattr(response, "content", None)
+    if isinstance(content, list):
+        for block in content:
+            if isinstance(block, dict):
+                image_url = block.get("image_url")
+                if image_url and image_url.get("url"):
+                    return image_url["url"].split(",")[-1]
+    # AIMessageChunkの場合の処理も考慮に入れる
+    image_url = (getattr(response, "additional_kwargs", None) or {}).get("image_url")
+    if image_url and image_url.get("url"):
+        return image_url["url"].split(",")[-1]
+
+    raise ValueError("No image URL found in the AI message response.")
+
+@lru_cache(maxsize=1)
+def _get_image_llm() -> ChatGoogleGenerativeAI:
+    """画像生成モデルは使われるまで作らず、初回に作ったものを以降も使い回す。"""
+    api_key = get_google_api_key()
+    if not api_key:
+        raise ValueError("GEMINI_API_KEY is not set in environment variables.")
+    return build_llm(config.GEMINI_IMAGE_MODEL, google_api_key=api_key)
+
 async def _image_generation_func(prompt: str) -> str:
-    """Generate an image asynchronously."""
-    try:
-        api_key = get_google_api_key()
-        if not api_key:
-            raise ValueError("GEMINI_API_KEY is not set in environment variables.")
-
-        image_model_name = os.getenv("GEMINI_IMAGE_MODEL", "gemini-2.0-flash-preview-image-generation")
-        llm = ChatGoogleGenerativeAI(model=image_model_name, google_api_key=api_key)
-
-        message = {
-            "role": "user",
-            "content": prompt,
-        }
-
-        response: BaseMessage = await llm.ainvoke(
-            [message],
-            generation_config=dict(response_modalities=["TEXT", "IMAGE"]),
-        )
-
-        def _get_image_base64(response: BaseMessage) -> str:
-            # AIMessageのcontentはリスト形式で、辞書やAIMessageChunkを含む可能性がある
-            # image_urlはAIMessageChunkのadditional_kwargsに含まれる場合がある
-            if isinstance(response, AIMessage):
-                for block in response.content:
-                    if isinstance(block, dict) and block.get("image_url"):
-                        return block["image_url"].get("url").split(",")[-1]
-            # AIMessageChunkの場合の処理も考慮に入れる
-            if hasattr(response, 'additional_kwargs') and 'image_url' in response.additional_kwargs:
-                return response.additional_kwargs['image_url'].get('url').split(',')[-1]
-            
-            raise ValueError("No image URL found in the AI message response.")
-
-        image_base64 = _get_image_base64(response)
-        return f"image_base64_data::{image_base64}" # プレフィックスを付けて返す
-    except Exception as e:
-        return f"Error generating image: {e}" # エラー時はプレフィックスなし
+    """Generate an image asynchronously.
+
+    失敗時は例外をそのまま送出し、execute_tool_node にツールエラーとして扱わせる。
+    """
+    llm = _get_image_llm()
+
+    message = {
+        "role": "user",
+        "content": prompt,
+    }
+
+    # テキスト向けの LLM_REQUEST_TIMEOUT_SECONDS では時間の掛かる生成が打ち切られるので、画像生成用の上限を使う
+    response: BaseMessage = await call_llm_limited(lambda: llm.ainvoke(
+        [message],
+        generation_config=IMAGE_GENERATION_CONFIG,
+    ), timeout=IMAGE_GENERATION_TIMEOUT_SECONDS)
+
+    image_base64 = _get_image_base64(response)
+    return f"image_base64_data::{image_base64}" # プレフィックスを付けて返す
 
 image_generation_tool = StructuredTool.from_function(
     func=_image_generation_func,
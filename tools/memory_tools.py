@@ -3,19 +3,29 @@ from pydantic import BaseModel, Field
 import json
 import logging
 import re
-from functools import partial
+from functools import lru_cache, partial
 
-from langchain_core.tools import BaseTool
-from langchain.tools import StructuredTool
+from langchain_core.tools import BaseTool, StructuredTool
 from langchain_google_genai import ChatGoogleGenerativeAI
 from langchain_core.prompts import ChatPromptTemplate
-from llm_config import get_google_api_key
+from llm_config import build_llm, call_llm_limited, get_google_api_key, load_system_instruction
 from .db_utils import save_memory
 from .vector_store_utils import VectorStoreManager
 from langchain_core.documents import Document
 
 logger = logging.getLogger(__name__)
 
+# LLM出力の ```json ... ``` ブロックを取り出す
+_JSON_FENCE_RE = re.compile(r"```json\s*(.*?)\s*```", re.DOTALL)
+
+# 記憶の構造化と想起の回答生成に使うモデル
+MEMORY_MODEL_NAME = "gemini-2.5-flash-preview-05-20"
+
+@lru_cache(maxsize=1)
+def _get_memory_llm() -> ChatGoogleGenerativeAI:
+    """記憶ツール用のLLMを初回呼び出し時に1度だけ作り、以降は使い回す。"""
+    return build_llm(MEMORY_MODEL_NAME, google_api_key=get_google_api_key())
+
 class RememberInput(BaseModel):
     """Input for the remember_information tool."""
     text_to_remember: str = Field(description="The text content that the user wants to remember.")
@@ -45,11 +55,10 @@ async def remember_information_func(
             logger.error("Google API Key not found.")
             return "エラー: Google APIキーが設定されていません。"
 
-        llm = ChatGoogleGenerativeAI(model="gemini-2.5-flash-preview-05-20", google_api_key=google_api_key)
+        llm = _get_memory_llm()
 
         try:
-            with open("prompts/structure_memory_prompt.txt", "r", encoding="utf-8") as f:
-                prompt_content = f.read()
+            prompt_content = load_system_instruction("prompts/structure_memory_prompt.txt")
         except FileNotFoundError:
             logger.error("prompts/structure_memory_prompt.txt not found.")
             return "エラー: 記憶構造化プロンプトファイルが見つかりません。"
@@ -57,23 +66,24 @@ async def remember_information_func(
         prompt_template = ChatPromptTemplate.from_template(prompt_content)
         chain = prompt_template | llm
 
-        logger.info(f"Structuring memory for: {text_to_remember}")
-        structured_response = await chain.ainvoke({"user_input": text_to_remember})
-        structured_data_str = str(structured_response.content)
+        logger.info("Structuring memory for: %s", text_to_remember)
+        structured_response = await call_llm_limited(lambda: chain.ainvoke({"user_input": text_to_remember}))
+        content = structured_response.content
+        structured_data_str = content if isinstance(content, str) else str(content)
 
         processed_str = ""
         llm_output_str = structured_data_str.strip()
 
         try:
-            match = re.search(r"```json\s*(.*?)\s*```", llm_output_str, re.DOTALL)
+            match = _JSON_FENCE_RE.search(llm_output_str) if "```" in llm_output_str else None
             if match:
                 processed_str = match.group(1).strip()
             else:
                 processed_str = llm_output_str.strip()
             structured_data_json = json.loads(processed_str)
-            logger.info(f"Structured data: {structured_data_json}")
+            logger.info("Structured data: %s", structured_data_json)
         except json.JSONDecodeError as e:
-            logger.error(f"Failed to parse LLM output as JSON: '{llm_output_str}' (processed: '{processed_str}') - Error: {e}")
+            logger.error("Failed to parse LLM output as JSON: '%s' (processed: '%s') - Error: %s", llm_output_str, processed_str, e)
             structured_data_json = {"raw_structured_text": llm_output_str, "error": "JSON parsing failed"}
 
         memory_id = save_memory(
@@ -84,7 +94,7 @@ async def remember_information_func(
             structured_data=json.dumps(structured_data_json, ensure_ascii=False)
         )
         if memory_id is None:
-            logger.info(f"Memory (key derived from '{text_to_remember[:30]}...') likely already exists or DB error for user {user_id}. Skipping vector store addition as well.")
+            logger.info("Memory (key derived from '%s...') likely already exists or DB error for user %s. Skipping vector store addition as well.", text_to_remember[:30], user_id)
             return "その情報は既に記憶されているか、データベースへの保存に問題がありました。"
         
         # memory_id が None でない場合のみベクトルストアに追加
@@ -98,14 +108,14 @@ async def remember_information_func(
             page_content=text_to_remember,
             metadata=metadata
         )
-        logger.info(f"Adding document to vector store. Page content: '{document.page_content}', Metadata: {document.metadata}")
-        vector_store_manager.add_documents([document])
+        logger.info("Adding document to vector store. Page content: '%s', Metadata: %s", document.page_content, document.metadata)
+        await vector_store_manager.aadd_documents([document])
 
-        logger.info(f"Memory embedded and saved to vector store with ID: {memory_id}")
+        logger.info("Memory embedded and saved to vector store with ID: %s", memory_id)
         return f"情報を記憶しました。(ID: {memory_id})"
 
     except Exception as e:
-        logger.error(f"Error in remember_information_func: {e}", exc_info=True)
+        logger.error("Error in remember_information_func: %s", e, exc_info=True)
         return f"記憶処理中にエラーが発生しました: {e}"
 
 async def recall_information_func(
@@ -118,41 +128,41 @@ async def recall_information_func(
     Recalls information from vector store and SQLite based on user query,
     then generates an answer using an LLM.
     """
-    logger.info(f"Recalling information for query: '{query}' for user {user_id} in server {server_id}")
+    logger.info("Recalling information for query: '%s' for user %s in server %s", query, user_id, server_id)
     retrieved_info_parts = []
 
     try:
-        similar_docs_with_scores = vector_store_manager.search_similar_documents(query, k=5)
+        similar_docs_with_scores = await vector_store_manager.asearch_similar_documents(query, k=5)
 
         if similar_docs_with_scores:
-            logger.info(f"Found {len(similar_docs_with_scores)} similar docs from vector store for query '{query}'.")
+            logger.info("Found %s similar docs from vector store for query '%s'.", len(similar_docs_with_scores), query)
             count = 0
             for doc, score in similar_docs_with_scores:
-                logger.info(f"  Checking doc from vector store: Content='{doc.page_content[:50]}...', Score={score:.4f}, Metadata={doc.metadata}")
-                logger.info(f"  Comparing with: query_user_id='{user_id}', query_server_id='{server_id}'")
+                logger.info("  Checking doc from vector store: Content='%s...', Score=%.4f, Metadata=%s", doc.page_content[:50], score, doc.metadata)
+                logger.info("  Comparing with: query_user_id='%s', query_server_id='%s'", user_id, server_id)
                 if doc.metadata.get("user_id") == user_id and doc.metadata.get("server_id") == server_id:
                     retrieved_info_parts.append(
                         f"- (類似度: {score:.4f}) 記憶された内容: {doc.page_content}\n  (DB ID: {doc.metadata.get('memory_db_id')}, チャンネル: {doc.metadata.get('channel_id')})"
                     )
                     count += 1
-                    logger.info(f"  MATCH! Appended to retrieved_info_parts. Current count: {count}, retrieved_info_parts length: {len(retrieved_info_parts)}") # 追加ログ
+                    logger.info("  MATCH! Appended to retrieved_info_parts. Current count: %s, retrieved_info_parts length: %s", count, len(retrieved_info_parts)) # 追加ログ
                     if count >= 3:
                         logger.info("  Reached max relevant docs (3). Breaking loop.") # 追加ログ
                         break
                 else:
-                    logger.debug(f"Skipping doc due to metadata mismatch: user_id={doc.metadata.get('user_id')} vs {user_id}, server_id={doc.metadata.get('server_id')} vs {server_id}")
+                    logger.debug("Skipping doc due to metadata mismatch: user_id=%s vs %s, server_id=%s vs %s", doc.metadata.get('user_id'), user_id, doc.metadata.get('server_id'), server_id)
             
-            logger.info(f"After loop - Final retrieved_info_parts length: {len(retrieved_info_parts)}") # 追加ログ
+            logger.info("After loop - Final retrieved_info_parts length: %s", len(retrieved_info_parts)) # 追加ログ
             if retrieved_info_parts:
-                logger.info(f"Filtered {len(retrieved_info_parts)} relevant docs for user {user_id}, server {server_id}.")
+                logger.info("Filtered %s relevant docs for user %s, server %s.", len(retrieved_info_parts), user_id, server_id)
         else:
-            logger.info(f"No similar docs found in vector store for query '{query}'.")
+            logger.info("No similar docs found in vector store for query '%s'.", query)
     except Exception as e:
-        logger.error(f"Error during vector store search in recall_information_func: {e}", exc_info=True)
+        logger.error("Error during vector store search in recall_information_func: %s", e, exc_info=True)
         retrieved_info_parts.append("ベクトルストアからの情報検索中にエラーが発生しました。")
 
     if not retrieved_info_parts:
-        logger.info(f"No relevant information found in memories for query '{query}', user {user_id}, server {server_id}.")
+        logger.info("No relevant information found in memories for query '%s', user %s, server %s.", query, user_id, server_id)
         return "関連する情報は見つかりませんでした。"
 
     try:
@@ -160,30 +170,29 @@ async def recall_information_func(
         if not google_api_key:
             return "エラー: Google APIキーが設定されていません。"
 
-        llm = ChatGoogleGenerativeAI(model="gemini-2.5-flash-preview-05-20", google_api_key=google_api_key)
-        
+        llm = _get_memory_llm()
+
         try:
-            with open("prompts/answer_from_memory_prompt.txt", "r", encoding="utf-8") as f:
-                prompt_content = f.read()
+            prompt_content = load_system_instruction("prompts/answer_from_memory_prompt.txt")
         except FileNotFoundError:
             logger.error("prompts/answer_from_memory_prompt.txt not found.")
             return "エラー: 回答生成プロンプトファイルが見つかりません。"
 
         prompt_template = ChatPromptTemplate.from_template(prompt_content)
         context_for_llm = "\n".join(retrieved_info_parts)
-        logger.debug(f"Context for LLM (recall): {context_for_llm}")
+        logger.debug("Context for LLM (recall): %s", context_for_llm)
 
         chain = prompt_template | llm
-        response = await chain.ainvoke({
+        response = await call_llm_limited(lambda: chain.ainvoke({
             "retrieved_memories": context_for_llm,
             "user_query": query
-        })
-        final_answer = str(response.content)
-        logger.info(f"LLM generated answer from recall: {final_answer}")
+        }))
+        final_answer = response.content if isinstance(response.content, str) else str(response.content)
+        logger.info("LLM generated answer from recall: %s", final_answer)
         return final_answer
 
     except Exception as e:
-        logger.error(f"Error during LLM answer generation in recall_information_func: {e}", exc_info=True)
+        logger.error("Error during LLM answer generation in recall_information_func: %s", e, exc_info=True)
         return f"回答生成中にエラーが発生しました: {e}"
 
 def create_memory_tools(vector_store_manager_instance: VectorStoreManager) -> Tuple[BaseTool, BaseTool]:
@@ -1,4 +1,5 @@
 import asyncio
+import logging
 from datetime import datetime, timedelta
 from typing import Type
 import discord # 追加
@@ -8,6 +9,8 @@ from discord.abc import Messageable # 追加: Messageableをインポート
 from pydantic import BaseModel, Field
 from langchain_core.tools import StructuredTool
 
+logger = logging.getLogger(__name__)
+
 class TimerInput(BaseModel):
     """Input for the timer tool."""
     minutes: int = Field(description="The number of minutes to set the timer for.")
@@ -23,27 +26,26 @@ async def _send_timer_notification(bot: commands.Bot, channel_id: str, user_id:
             # チャンネルがメッセージ送信可能か確認
             if isinstance(channel, Messageable):
                 await channel.send(f"<@{user_id}> {message}")
-                print(f"Timer notification sent to channel {channel_id} for user {user_id}.")
+                logger.info("Timer notification sent to channel %s for user %s.", channel_id, user_id)
             else:
-                print(f"Error: Channel {channel_id} (type: {type(channel).__name__}) is not a messageable channel.")
+                logger.error("Channel %s (type: %s) is not a messageable channel.", channel_id, type(channel).__name__)
         else:
-            print(f"Error: Channel {channel_id} not found for timer notification.")
+            logger.error("Channel %s not found for timer notification.", channel_id)
     except Exception as e:
-        print(f"Error sending timer notification: {e}")
+        logger.error("Error sending timer notification: %s", e)
 
 async def _set_timer_func(bot: commands.Bot, minutes: int, channel_id: str, user_id: str, message: str) -> str:
-    """Sets a timer and sends a notification to the specified Discord channel."""
-    try:
-        if minutes <= 0:
-            return "Timer duration must be a positive number of minutes."
+    """Sets a timer and sends a notification to the specified Discord channel.
 
-        # バックグラウンドで通知タスクを起動
-        asyncio.create_task(_perform_timer_wait_and_notify(bot, minutes, channel_id, user_id, message))
+    予期しない例外は文字列に包まずに送出し、execute_tool_node にツールエラーとして扱わせる。
+    """
+    if minutes <= 0:
+        return "Timer duration must be a positive number of minutes."
 
-        return f"タイマーを{minutes}分に設定しました。時間になったらお知らせします。" # すぐに確認メッセージを返す
+    # バックグラウンドで通知タスクを起動
+    asyncio.create_task(_perform_timer_wait_and_notify(bot, minutes, channel_id, user_id, message))
 
-    except Exception as e:
-        return f"Error setting timer: {e}"
+    return f"タイマーを{minutes}分に設定しました。時間になったらお知らせします。" # すぐに確認メッセージを返す
 
 async def _perform_timer_wait_and_notify(bot: commands.Bot, minutes: int, channel_id: str, user_id: str, message: str):
     """Waits for the specified time and then sends the notification."""
@@ -1,9 +1,10 @@
+import asyncio
 import os
 from langchain_community.vectorstores import FAISS
 from langchain_core.documents import Document
 from langchain_google_genai import GoogleGenerativeAIEmbeddings
 from pydantic import SecretStr
-from typing import List, Tuple
+from typing import List, Optional, Tuple
 import logging
 
 from llm_config import get_google_api_key
@@ -15,7 +16,7 @@ PROJECT_ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..')
 VECTOR_STORE_DIR = os.path.join(PROJECT_ROOT_DIR, 'data', 'vector_store_project_data') # 新しいサブディレクトリ名
 DEFAULT_FAISS_INDEX_NAME = "faiss_index_project_data" # デフォルトのインデックス名
 
-logger.info(f"Vector Store Dir: {VECTOR_STORE_DIR}")
+logger.info("Vector Store Dir: %s", VECTOR_STORE_DIR)
 
 class VectorStoreManager:
     def __init__(self, embedding_model_name: str = "models/embedding-001", index_name: str = DEFAULT_FAISS_INDEX_NAME):
@@ -24,9 +25,9 @@ class VectorStoreManager:
         
         try:
             os.makedirs(self.vector_store_folder, exist_ok=True)
-            logger.info(f"Ensured directory exists: {self.vector_store_folder}")
+            logger.info("Ensured directory exists: %s", self.vector_store_folder)
         except OSError as e:
-            logger.error(f"Could not create directory {self.vector_store_folder}: {e}", exc_info=True)
+            logger.error("Could not create directory %s: %s", self.vector_store_folder, e, exc_info=True)
             raise
 
         google_api_key_str = get_google_api_key()
@@ -39,15 +40,23 @@ class VectorStoreManager:
             google_api_key=SecretStr(google_api_key_str)
         )
         self.vector_store = self._load_vector_store()
+        # インデックスの変更・保存・検索を直列にするロック。保存はスレッドで行うので、その間に別の追加や検索が割り込まないようにする
+        # (このインスタンスはスレッドで生成されるので、ロックはイベントループ上での最初の使用時に作る)
+        self._index_lock: Optional[asyncio.Lock] = None
+
+    def _get_index_lock(self) -> asyncio.Lock:
+        if self._index_lock is None:
+            self._index_lock = asyncio.Lock()
+        return self._index_lock
 
     def _load_vector_store(self) -> FAISS:
         faiss_file = os.path.join(self.vector_store_folder, f"{self.index_name}.faiss")
         pkl_file = os.path.join(self.vector_store_folder, f"{self.index_name}.pkl")
-        logger.info(f"Attempting to load vector store from folder: {self.vector_store_folder}, index_name: {self.index_name}")
-        logger.info(f"Checking for files: {faiss_file}, {pkl_file}")
+        logger.info("Attempting to load vector store from folder: %s, index_name: %s", self.vector_store_folder, self.index_name)
+        logger.info("Checking for files: %s, %s", faiss_file, pkl_file)
 
         if os.path.exists(faiss_file) and os.path.exists(pkl_file):
-            logger.info(f"Found existing vector store files. Attempting to load.")
+            logger.info("Found existing vector store files. Attempting to load.")
             try:
                 store = FAISS.load_local(
                     folder_path=self.vector_store_folder, 
@@ -55,18 +64,22 @@ class VectorStoreManager:
                     index_name=self.index_name,
                     allow_dangerous_deserialization=True
                 )
-                logger.info(f"Successfully loaded existing vector store.")
+                logger.info("Successfully loaded existing vector store.")
                 return store
             except Exception as e:
-                logger.error(f"Failed to load existing vector store: {e}. Creating a new store.", exc_info=True)
+                logger.error("Failed to load existing vector store: %s. Creating a new store.", e, exc_info=True)
                 dummy_doc = [Document(page_content="initial document for new store after load fail", metadata={})]
                 return FAISS.from_documents(dummy_doc, self.embeddings)
         else:
-            logger.info(f"Vector store files not found. Creating a new store.")
+            logger.info("Vector store files not found. Creating a new store.")
             dummy_doc = [Document(page_content="initial document for new store", metadata={})]
             return FAISS.from_documents(dummy_doc, self.embeddings)
 
-    def add_documents(self, documents: List[Document]):
+    async def aadd_documents(self, documents: List[Document]):
+        """ドキュメントを追加して保存する。埋め込みAPIの呼び出しをイベントループ上で待ち、保存だけをスレッドで行う。
+
+        埋め込みの計算はロックの外で行い、インデックスへの追加から保存の完了まではロックを保持する。
+        """
         if not documents:
             logger.warning("No documents to add to vector store.")
             return
@@ -74,38 +87,46 @@ class VectorStoreManager:
             logger.error("Vector store not initialized. Cannot add documents.")
             return
         try:
-            self.vector_store.add_documents(documents)
-            logger.info(f"Successfully added {len(documents)} document(s) to in-memory vector store.")
-            self.save_vector_store()
+            texts = [doc.page_content for doc in documents]
+            embeddings = await self.embeddings.aembed_documents(texts)
+            async with self._get_index_lock():
+                self.vector_store.add_embeddings(zip(texts, embeddings), metadatas=[doc.metadata for doc in documents])
+                logger.info("Successfully added %s document(s) to in-memory vector store.", len(documents))
+                await asyncio.to_thread(self.save_vector_store)
         except Exception as e:
-            logger.error(f"Error adding documents to vector store: {e}", exc_info=True)
+            logger.error("Error adding documents to vector store: %s", e, exc_info=True)
 
-    def search_similar_documents(self, query: str, k: int = 3) -> List[Tuple[Document, float]]:
+    async def asearch_similar_documents(self, query: str, k: int = 3) -> List[Tuple[Document, float]]:
+        """クエリに近いドキュメントをスコア付きで返す。クエリの埋め込みでイベントループを止めない。"""
         if not self.vector_store:
             logger.error("Vector store not initialized. Cannot perform search.")
             return []
         try:
-            results = self.vector_store.similarity_search_with_score(query, k=k)
-            logger.info(f"Search for '{query}' found {len(results)} similar documents.")
+            query_embedding = await self.embeddings.aembed_query(query)
+            # 検索もスレッドで実行されるので、保存中のインデックスと同時に触らないようにロックを取る
+            async with self._get_index_lock():
+                results = await self.vector_store.asimilarity_search_with_score_by_vector(query_embedding, k=k)
+            logger.info("Search for '%s' found %s similar documents.", query, len(results))
             return results
         except Exception as e:
-            logger.error(f"Error during similarity search for '{query}': {e}", exc_info=True)
+            logger.error("Error during similarity search for '%s': %s", query, e, exc_info=True)
             return []
 
     def save_vector_store(self):
+        # aadd_documents がインデックスのロックを保持したままスレッドで呼び出す。それ以外から直接呼ばないこと
         if self.vector_store:
-            logger.info(f"Attempting to save vector store to folder: {self.vector_store_folder}, with index_name: {self.index_name}")
+            logger.info("Attempting to save vector store to folder: %s, with index_name: %s", self.vector_store_folder, self.index_name)
             try:
                 self.vector_store.save_local(folder_path=self.vector_store_folder, index_name=self.index_name)
-                logger.info(f"Successfully saved vector store.")
+                logger.info("Successfully saved vector store.")
                 
                 faiss_file_exists = os.path.exists(os.path.join(self.vector_store_folder, f"{self.index_name}.faiss"))
                 pkl_file_exists = os.path.exists(os.path.join(self.vector_store_folder, f"{self.index_name}.pkl"))
-                logger.info(f"Post-save check: {self.index_name}.faiss exists: {faiss_file_exists}")
-                logger.info(f"Post-save check: {self.index_name}.pkl exists: {pkl_file_exists}")
+                logger.info("Post-save check: %s.faiss exists: %s", self.index_name, faiss_file_exists)
+                logger.info("Post-save check: %s.pkl exists: %s", self.index_name, pkl_file_exists)
                 if not faiss_file_exists or not pkl_file_exists:
                     logger.error("CRITICAL: Vector store files do NOT exist immediately after saving!")
             except Exception as e:
-                logger.error(f"Failed to save vector store: {e}", exc_info=True)
+                logger.error("Failed to save vector store: %s", e, exc_info=True)
         else:
             logger.warning("No vector store instance to save.")